@@ -0,0 +1,4 @@
+"""Benchmarks for lownote: benchmarks.generate makes synthetic notebooks of
+any size and benchmarks.run times the Noter and the interface against them
+and compares runs. Run them from the top of the source tree, e.g.
+    python -m benchmarks.run -n 10000 -o results.json"""
@@ -0,0 +1,73 @@
+"""Just enough of the curses module for lownote.interface to run without a
+terminal, so the benchmarks time the interface's own work (layout,
+highlighting, keeping the index) rather than the terminal's. Call install()
+before lownote.interface is first imported."""
+import sys
+
+class error(Exception):
+    pass
+
+ACS_VLINE = ord("|")
+KEY_RESIZE = 410
+
+class Window(object):
+    """Keeps track of the cursor and nothing else; output is thrown away."""
+
+    def __init__(self, height, width, y=0, x=0):
+        self.height = height
+        self.width = width
+        self.cursor = (0, 0)
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def getyx(self):
+        return self.cursor
+
+    def move(self, y, x):
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            raise error("move")
+        self.cursor = (y, x)
+
+    def addstr(self, string, attr=0):
+        y, x = self.cursor
+        lines = string.split("\n")
+        if len(lines) > 1:
+            y += len(lines) - 1
+            x = 0
+        x += len(lines[-1])
+        self.cursor = (min(y + x // self.width, self.height - 1),
+                        x % self.width)
+
+    def resize(self, height, width):
+        self.height = height
+        self.width = width
+
+    def getkey(self):
+        raise error("no input")
+
+    def getstr(self, y, x, length):
+        return ""
+
+    def _ignore(self, *args):
+        pass
+
+    keypad = scrollok = timeout = attrset = vline = refresh = noutrefresh = \
+        touchwin = clrtoeol = erase = clear = insertln = deleteln = mvwin = \
+        _ignore
+
+def newwin(height, width, y=0, x=0):
+    return Window(height, width, y, x)
+
+def color_pair(number):
+    return number << 8
+
+def _ignore(*args):
+    pass
+
+start_color = use_default_colors = init_pair = curs_set = echo = noecho = \
+    doupdate = _ignore
+
+def install():
+    """Put this module in place of curses."""
+    sys.modules["curses"] = sys.modules[__name__]
@@ -0,0 +1,123 @@
+"""Deterministic synthetic notebooks for the benchmarks. The same seed and
+size always give the same notes, so two benchmark runs (e.g. before and
+after a change) are measured against identical data.
+
+Keywords and topics are drawn from Zipf-like distributions, so a few are
+very common and most are rare, the way a real notebook's are; a share of
+each note's keywords are marked up explicitly as %%keyword%% and the rest
+are left for the keyword matcher to find. Notes are written out as records
+(see lownote.transfer), so a notebook can also be generated to a file:
+    python -m benchmarks.generate -n 100000 -o notes.jsonl
+or straight into a database with -p."""
+from optparse import OptionParser
+import bisect
+import datetime
+import json
+import random
+
+_syllables = ["ka", "lo", "mi", "ne", "ru", "ta", "vo", "shi", "zen", "pa",
+              "do", "ri", "gu", "fe", "lan", "mor", "tek", "bis", "qua", "yo"]
+
+# Filler for the rest of each body, common enough never to be keywords:
+_filler = ("the a to of and in is it that for on with as was at by this be "
+           "from or have an but not are they which you one all were we when "
+           "there can more if out so what up about into than them some "
+           "then other time could these two may first any like now over "
+           "also after back well way even new want because most us").split()
+
+class NotebookGenerator(object):
+    """Makes the vocabulary up front from the seed, then yields notes from
+    it; every call to records() with the same arguments yields the same
+    notes."""
+
+    def __init__(self, seed=0, keywords=5000, topics=200,
+                    keyword_density=0.05, explicit_share=0.3, skew=1.1):
+        self.seed = seed
+        self.keyword_density = keyword_density
+        self.explicit_share = explicit_share
+        random_ = random.Random(seed)
+        self.keywords = self._make_words(random_, keywords, 2, 4)
+        self.topics = self._make_words(random_, topics, 2, 3)
+        self.keyword_weights = self._cumulative(len(self.keywords), skew)
+        self.topic_weights = self._cumulative(len(self.topics), skew)
+
+    def _make_words(self, random_, count, shortest, longest):
+        words = set()
+        while len(words) < count:
+            words.add("".join(random_.choice(_syllables)
+                    for _ in xrange(random_.randint(shortest, longest))))
+        words = sorted(words)
+        random_.shuffle(words)
+        return words
+
+    def _cumulative(self, count, skew):
+        weights = []
+        total = 0.0
+        for rank in xrange(1, count + 1):
+            total += 1.0 / rank ** skew
+            weights.append(total)
+        return [x / total for x in weights]
+
+    def _pick(self, random_, words, weights):
+        return words[min(bisect.bisect(weights, random_.random()),
+                         len(words) - 1)]
+
+    def body(self, random_):
+        """One note body of 10 to 80 words."""
+        words = []
+        for _ in xrange(random_.randint(10, 80)):
+            if random_.random() < self.keyword_density:
+                keyword = self._pick(random_, self.keywords,
+                                        self.keyword_weights)
+                if random_.random() < self.explicit_share:
+                    keyword = "%%" + keyword + "%%"
+                words.append(keyword)
+            else:
+                words.append(random_.choice(_filler))
+        return " ".join(words)
+
+    def records(self, count, offset=0, start=datetime.datetime(2000, 1, 1)):
+        """Yield count records, each with a body, zero to three topics and a
+        date, dates going forward from start. A different offset gives a
+        different run of notes dated later on, e.g. for notes to add to a
+        notebook made from the first offset records."""
+        random_ = random.Random("%s:%d" % (self.seed, offset))
+        date = start + datetime.timedelta(minutes=offset * 37)
+        for _ in xrange(count):
+            topics = set(self._pick(random_, self.topics, self.topic_weights)
+                         for _ in xrange(random_.randint(0, 3)))
+            date += datetime.timedelta(minutes=random_.randint(1, 73))
+            yield {"body": self.body(random_), "topics": sorted(topics),
+                   "date": date.isoformat()}
+
+def build_notebook(db_path, count, seed=0, batch_size=1000):
+    """Fill the (new) database at db_path with count generated notes and
+    return the number added."""
+    from lownote.noter import Noter
+    notetaker = Noter(db_path)
+    return notetaker.import_notes(NotebookGenerator(seed).records(count),
+                                  batch_size=batch_size)
+
+def main():
+    parser = OptionParser(usage="%prog -n COUNT (-o FILE | -p DB)")
+    parser.add_option("-n", "--notes", type="int", default=1000,
+                        dest="count", help="Number of notes to generate.")
+    parser.add_option("-s", "--seed", type="int", default=0, dest="seed")
+    parser.add_option("-o", "--output", dest="output_path", default=None,
+                        help="Write the notes to this file as JSON lines.")
+    parser.add_option("-p", "--path", dest="db_path", default=None,
+                        help="Import the notes into this database.")
+    options, args = parser.parse_args()
+
+    if options.db_path:
+        build_notebook(options.db_path, options.count, options.seed)
+    elif options.output_path:
+        f = open(options.output_path, "w")
+        for record in NotebookGenerator(options.seed).records(options.count):
+            f.write(json.dumps(record) + "\n")
+        f.close()
+    else:
+        parser.error("Give either -o or -p.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""Time the main Noter operations and the interface's drawing against a
+generated notebook (see benchmarks.generate) and write the results to JSON;
+two result files can then be compared to spot regressions:
+    python -m benchmarks.run -n 10000 -o before.json
+    (make the change)
+    python -m benchmarks.run -n 10000 -o after.json
+    python -m benchmarks.run --compare before.json after.json
+
+Each notebook is generated once per size and seed and kept in --data-dir,
+and every run works on a fresh copy of it, so the benchmarks that add notes
+don't change what the next run measures. curses is replaced by
+benchmarks.curses_stub, so the interface timings leave the terminal out."""
+from optparse import OptionParser
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import curses_stub
+from benchmarks.generate import NotebookGenerator
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def summarise(times, per=1):
+    """Seconds per operation for a list of timings, each of per
+    operations."""
+    times = sorted(x / per for x in times)
+    middle = len(times) // 2
+    if len(times) % 2:
+        median = times[middle]
+    else:
+        median = (times[middle - 1] + times[middle]) / 2
+    return {"min": times[0], "median": median,
+            "mean": sum(times) / len(times), "runs": len(times)}
+
+def notebook_path(data_dir, count, seed):
+    """Return the path of the generated notebook of count notes, generating
+    it first if it isn't there yet. It's generated in another process as
+    Noter can only be set up once per process."""
+    path = os.path.join(data_dir, "notebook-%d-%d.sqlite" % (count, seed))
+    if not os.path.exists(path):
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        partial = path + ".partial"
+        if os.path.exists(partial):
+            os.unlink(partial)
+        sys.stderr.write("Generating %d notes in %s...\n" % (count, path))
+        subprocess.check_call([sys.executable, "-m", "benchmarks.generate",
+            "-n", str(count), "-s", str(seed), "-p", partial], cwd=root)
+        os.rename(partial, path)
+    return path
+
+class Benchmarks(object):
+    """Runs each benchmark against one Noter on a copy of the notebook and
+    collects the results by name."""
+
+    def __init__(self, db_path, count, seed, repeat, full_scan_limit):
+        from lownote.noter import Noter
+        self.db_path = db_path
+        self.count = count
+        self.repeat = repeat
+        self.full_scan_limit = full_scan_limit
+        self.random = random.Random(seed)
+        self.notetaker = Noter(db_path)
+        generator = NotebookGenerator(seed)
+        # Notes that aren't in the notebook yet, to add or parse:
+        self.records = list(generator.records(max(repeat, 50), offset=count))
+        self.keywords = generator.keywords
+        self.results = {}
+
+    def time(self, name, func, repeat=None, per=1):
+        """Call func repeat times and record how long each call took; per is
+        how many operations one call does."""
+        times = []
+        for i in xrange(repeat or self.repeat):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        self.results[name] = summarise(times, per)
+
+    def sample_ids(self, count):
+        """Ids of notes spread through the notebook."""
+        top = self.notetaker.get_note_page(limit=1)[0].id
+        return [self.random.randint(1, top) for _ in xrange(count)]
+
+    def startup(self):
+        """Cold start: a new interpreter importing the database code and
+        opening the notebook, with a bare interpreter start for reference."""
+        def run(code):
+            return lambda: subprocess.check_call([sys.executable, "-c", code],
+                                                  cwd=root)
+        self.time("startup.interpreter", run("pass"), repeat=5)
+        self.time("startup.open_notebook", run("from lownote.noter import "
+            "Noter; Noter(%r)" % (self.db_path,)), repeat=5)
+
+    def noter(self):
+        notetaker = self.notetaker
+        bodies = iter([x["body"] for x in self.records])
+        self.time("noter.add_note",
+                  lambda: notetaker.add_note(bodies.next()))
+
+        def get_keywords():
+            for record in self.records:
+                list(notetaker.get_keywords(record["body"]))
+        self.time("noter.get_keywords", get_keywords, per=len(self.records))
+
+        def get_matcher():
+            notetaker.matcher = None
+            notetaker.get_matcher()
+        self.time("noter.get_matcher", get_matcher, repeat=5)
+
+        if self.count <= self.full_scan_limit:
+            self.time("noter.get_notes", lambda: list(notetaker.get_notes()),
+                      repeat=3)
+
+        def page_through():
+            page = notetaker.get_note_page()
+            for _ in xrange(20):
+                page = notetaker.get_note_page(before=page[-1].id)
+        self.time("noter.get_note_page", page_through, per=21)
+
+        ids = self.sample_ids(self.repeat)
+        self.time("noter.get_note", lambda: notetaker.get_note(ids.pop()))
+
+        notetaker.get_changes()
+        self.time("noter.get_changes.idle", notetaker.get_changes)
+
+        def changes_after_add():
+            notetaker.add_note(self.random.choice(self.records)["body"])
+            start = time.time()
+            notetaker.get_changes()
+            return time.time() - start
+        self.results["noter.get_changes.after_add"] = summarise(
+            [changes_after_add() for _ in xrange(self.repeat)])
+
+        ids = self.sample_ids(self.repeat)
+        self.time("noter.related_notes", lambda: notetaker.related_notes(
+            notetaker.get_note_page(before=ids.pop() + 1, limit=1)[0]))
+
+        queries = [" ".join(self.random.sample(self.keywords[:50], 2))
+                   for _ in xrange(self.repeat)]
+        self.time("noter.search", lambda: notetaker.search(queries.pop()))
+
+    def interface(self):
+        curses_stub.install()
+        from lownote.interface import MainWindow, IndexWindow
+        from lownote.matcher import KeywordMatcher
+        notetaker = self.notetaker
+        keywords = KeywordMatcher(notetaker.get_stored_keywords())
+        display = MainWindow(0, 25, 40, 95)
+        notes = [notetaker.get_note(x) for x in self.sample_ids(self.repeat)]
+        notes = [x for x in notes if x is not None]
+
+        def layout():
+            for note in notes:
+                display.forget(note.id)
+                display.display_note(note, keywords)
+        self.time("interface.display_note.layout", layout, repeat=3,
+                  per=len(notes))
+
+        def cached():
+            for note in notes:
+                display.display_note(note, keywords)
+        self.time("interface.display_note.cached", cached, repeat=3,
+                  per=len(notes))
+
+        index = IndexWindow(0, 0, 60, 25)
+        index.set_source(notetaker.get_note_page)
+        self.time("interface.repopulate", index.repopulate)
+
+        def scroll():
+            for _ in xrange(500):
+                index.down()
+        self.time("interface.index_scroll", scroll, repeat=3, per=500)
+
+def get_meta(count, seed):
+    import sqlite3
+    import sqlalchemy
+    meta = {"notes": count, "seed": seed,
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform()}
+    try:
+        meta["revision"] = subprocess.Popen(["git", "rev-parse", "HEAD"],
+            cwd=root, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        pass
+    return meta
+
+def compare(base_path, new_path, threshold, statistic="min"):
+    """Print how each benchmark's statistic (by default the fastest run,
+    which is the least affected by whatever else the machine was doing)
+    changed between two result files and return the names of those that
+    got slower by more than threshold."""
+    base, new = [json.load(open(x)) for x in (base_path, new_path)]
+    for key in ("notes", "seed"):
+        if base["meta"].get(key) != new["meta"].get(key):
+            print "Warning: the runs differ in %s (%s and %s)" % (key,
+                base["meta"].get(key), new["meta"].get(key))
+
+    regressions = []
+    print "%-32s %12s %12s %8s" % ("benchmark (%s)" % (statistic,),
+                                   "base (ms)", "new (ms)", "change")
+    for name in sorted(set(base["results"]) | set(new["results"])):
+        if name not in base["results"] or name not in new["results"]:
+            print "%-32s %s" % (name, "only in one run")
+            continue
+        before = base["results"][name][statistic]
+        after = new["results"][name][statistic]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print "%-32s %12.3f %12.3f %+7.1f%%%s" % (name, before * 1000,
+            after * 1000, change * 100, flag)
+    return regressions
+
+def main():
+    parser = OptionParser(usage="%prog [-n COUNT] [-o FILE] | "
+                                "--compare BASE NEW")
+    parser.add_option("-n", "--notes", type="int", default=10000,
+                        dest="count", help="Notes in the notebook.")
+    parser.add_option("-s", "--seed", type="int", default=0, dest="seed")
+    parser.add_option("-r", "--repeat", type="int", default=100,
+                        dest="repeat", help="Runs of each benchmark.")
+    parser.add_option("-o", "--output", dest="output_path", default=None,
+                        help="Write the results here (default stdout).")
+    parser.add_option("--data-dir", dest="data_dir",
+                        default=os.path.join(root, "benchmarks", "data"),
+                        help="Where generated notebooks are kept.")
+    parser.add_option("--full-scan-limit", type="int", default=100000,
+                        dest="full_scan_limit", help=("Skip the benchmarks "
+                        "that read every note above this many notes."))
+    parser.add_option("--compare", action="store_true", default=False,
+                        dest="compare", help="Compare two result files.")
+    parser.add_option("--threshold", type="float", default=0.1,
+                        dest="threshold", help=("How much slower counts as "
+                        "a regression (0.1 is 10%)."))
+    parser.add_option("--statistic", type="choice", default="min",
+                        choices=["min", "median", "mean"], dest="statistic",
+                        help="Which timing to compare (default min).")
+    options, args = parser.parse_args()
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files.")
+        if compare(args[0], args[1], options.threshold, options.statistic):
+            raise SystemExit(1)
+        return
+
+    source = notebook_path(options.data_dir, options.count, options.seed)
+# The copy is opened in WAL mode, so it gets -wal and -shm files next to it;
+# it's made in a directory of its own so that all of them go at the end and a
+# later run never starts on what this one left behind:
+    work_dir = tempfile.mkdtemp(prefix="lownote-benchmark-")
+    db_path = os.path.join(work_dir, os.path.basename(source))
+    shutil.copyfile(source, db_path)
+    try:
+        benchmarks = Benchmarks(db_path, options.count, options.seed,
+                                options.repeat, options.full_scan_limit)
+        try:
+            benchmarks.startup()
+            benchmarks.noter()
+            benchmarks.interface()
+        finally:
+            benchmarks.notetaker.engine.dispose()
+    finally:
+        shutil.rmtree(work_dir)
+
+    output = json.dumps({"meta": get_meta(options.count, options.seed),
+                         "results": benchmarks.results},
+                        indent=2, sort_keys=True)
+    if options.output_path:
+        f = open(options.output_path, "w")
+        f.write(output + "\n")
+        f.close()
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
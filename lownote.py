@@ -20,6 +20,36 @@ Add notes from the command line:
 Available options (these must precede the actual body of the note):
     -t [topic]  Specify the topic of the note (can be used multiple times).
     -i          Load in interactive mode (default if no options are given).
+    --import FILE
+                Add every note in FILE (JSON lines or plain text paragraphs,
+                "-" for standard input) in batched transactions.
+    --export FORMAT
+                Write every note out as jsonl (which --import reads back) or
+                markdown, to --output or standard output; -t and --since
+                limit which notes are exported.
+    --backfill  Link older notes to the keywords that were first used after
+                them; this also happens in the background while the
+                interface or --serve is running.
+    --reindex   Find every note's keywords again, in parallel over --jobs
+                processes; an interrupted run carries on where it left off.
+    --serve     Keep running and add notes sent over a Unix socket (see
+                lownote.daemon); while it runs, adding a note from the
+                command line goes through it instead of opening the database.
+    --startup-profile
+                Print how long importing and opening the database took.
+
+In interactive mode j and k move through the notes and / searches them. d
+deletes the selected note, or every marked note: m marks (or unmarks) a note,
+M marks every note from the one last marked to the selected one, T marks
+every note under a topic and C clears the marks. u brings back what was last
+deleted; deleted notes are purged for good after a week. Tab moves between
+the notes and the topics above them, which list how many notes are under
+each; moving through the topics lists just the notes under the one selected.
+
+Setting LOWNOTE_INSTRUMENT (or "instrument" in the rc file) to yes, or to a
+file name, times every database operation and screen update, shows the
+timings on a status line and writes them out on exit (see
+lownote.instrument).
 
 The interactive mode (i.e. the actual interface to your notes) uses ncurses.
 
@@ -27,12 +57,52 @@ The notes are stored in a SQLite database and SQLALchemy is used to interface
 with it.
 """
 
+import time
+started = time.time()
 from optparse import OptionParser
-import curses
-import traceback
-from lownote.noter import Noter
+import os
+import sys
 from lownote.rcfile import load_rc
-from lownote.interface import Interface
+from lownote.transfer import open_input, read_records, open_output, writers
+from lownote.model import parse_due_date
+from lownote.client import send_request, DaemonUnavailable, DaemonError
+# Only what every run needs is imported up here. SQLAlchemy (by way of
+# lownote.noter) is most of the startup time and curses and the interface
+# are only for interactive mode, so those are imported where they're used;
+# adding a note through the daemon never imports any of them.
+
+# (what, when) for --startup-profile:
+startup_marks = [("start", started)]
+
+def mark(what):
+    startup_marks.append((what, time.time()))
+
+def report_startup():
+    """Print how long each step of startup took, on stderr."""
+    for i in xrange(1, len(startup_marks)):
+        sys.stderr.write("%-28s %7.1f ms\n" % (startup_marks[i][0],
+            (startup_marks[i][1] - startup_marks[i - 1][1]) * 1000))
+    sys.stderr.write("%-28s %7.1f ms\n" % ("total",
+                        (startup_marks[-1][1] - started) * 1000))
+
+def open_noter(options):
+    """Import the database code and open the notes database."""
+    from lownote.noter import Noter
+    mark("import lownote.noter")
+    storage = {}
+    for key in Noter.storage_defaults:
+        if getattr(options, key, None) is not None:
+            storage[key] = getattr(options, key)
+    try:
+        notetaker = Noter(options.db_path, storage)
+    except ValueError, e:
+        sys.stderr.write("Bad storage setting in the rc file: %s\n" % (e,))
+        raise SystemExit(1)
+    mark("open database")
+    if options.recorder is not None:
+        from lownote.instrument import instrument_noter
+        instrument_noter(notetaker, options.recorder)
+    return notetaker
 
 def get_args():
     """Get the command line arguments and return them in the form:
@@ -42,7 +112,8 @@ def get_args():
 
     The reason for passing "DEFAULT" instead of an actual default is so that
     when the rc file is loaded it know whether to override the default or not;
-    I couldn't think of another way of doing this.
+    I couldn't think of another way of doing this. Numeric options use None
+    instead, as optparse insists their defaults are numbers.
     """
     parser = OptionParser()
     parser.add_option("-t", "--topic", action="append", type="string",
@@ -57,12 +128,51 @@ def get_args():
     parser.add_option("-p", "--path", action="store", type="string",
                         help="Specify a path for the notes database.",
                         default="DEFAULT", dest="db_path")
+    parser.add_option("--import", action="store", type="string",
+                        help=("Import notes from a file of JSON lines or "
+                        "plain text paragraphs (- for stdin)."),
+                        dest="import_path", default=None)
+    parser.add_option("--batch-size", action="store", type="int",
+                        help="Notes written per transaction when importing.",
+                        default=None, dest="batch_size")
+    parser.add_option("--export", action="store", type="choice",
+                        choices=sorted(writers.keys()),
+                        help=("Export the notes as jsonl or markdown (only "
+                        "those under any -t topic if given)."),
+                        dest="export_format", default=None)
+    parser.add_option("--since", action="store", type="string",
+                        help=("Only export notes made on or after this date "
+                        "(YYYYMMDD)."), dest="since", default=None)
+    parser.add_option("-o", "--output", action="store", type="string",
+                        help="File to export to instead of standard output.",
+                        dest="output_path", default=None)
+    parser.add_option("--backfill", action="store_true", default=False,
+                        help=("Link older notes to keywords that were "
+                        "introduced after them."), dest="backfill")
+    parser.add_option("--reindex", action="store_true", default=False,
+                        help=("Rebuild the keyword links of every note "
+                        "from its body."), dest="reindex")
+    parser.add_option("--jobs", action="store", type="int",
+                        help=("Processes to reindex with (default one per "
+                        "CPU)."), default=None, dest="jobs")
+    parser.add_option("--serve", action="store_true", default=False,
+                        help=("Run as a daemon answering requests on the "
+                        "socket, which speeds up adding notes."),
+                        dest="serve")
+    parser.add_option("--socket", action="store", type="string",
+                        help="Specify a path for the daemon's socket.",
+                        default="DEFAULT", dest="socket_path")
+    parser.add_option("--startup-profile", action="store_true",
+                        default=False, dest="startup_profile",
+                        help="Print how long each step of startup took.")
     parser.add_option("-i", "--interactive", action="store_true",
                         default=False, dest="interactive",
                         help=("Proceed into interactive mode after adding a "
                         "note (default behaviour if no notes are added."))
 
     (options, args) = parser.parse_args()
+# Instrumentation is turned on from the environment, or else the rc file:
+    options.instrument = os.environ.get("LOWNOTE_INSTRUMENT")
 
     options = load_rc(options)
     return options, " ".join(args)
@@ -71,29 +181,132 @@ def load_interface(scr, options):
     """Load the interface module, passing it the curses scren received from
     init_interface and feed it the information from the database."""
 
-    notetaker = Noter(options.db_path)
-    interface = Interface(scr,
-        callback=lambda interface, **kwargs: update_notes(interface, notetaker,
-                                                                  **kwargs))
-    for note in notetaker.get_notes():
-        interface.add_note(note)
-
-    for keyword in notetaker.get_stored_keywords():
-        interface.add_keyword(keyword)
-    interface.update()
-    interface.handle_events()
-    
-def update_notes(interface, notetaker, **kwargs):
+    from lownote.interface import Interface
+    from lownote.watch import watch
+    from lownote.worker import Worker
+    mark("import lownote.interface")
+# Everything that uses the session happens on the worker thread, so the
+# database is opened there too; only the listing is read from this thread
+# (see Noter._get_rows).
+    worker = Worker()
+    try:
+        notetaker = worker.call(open_noter, options)
+        keywords = worker.call(lambda: list(notetaker.get_stored_keywords()))
+        status = None
+        if options.recorder is not None:
+            status = options.recorder.status
+        interface = Interface(scr,
+            callback=lambda interface, **kwargs: update_notes(interface,
+                                                notetaker, worker, **kwargs),
+            pager=notetaker.get_note_page, loader=notetaker.get_note,
+            status=status, watcher=watch(options.db_path), worker=worker)
+        if options.recorder is not None:
+            from lownote.instrument import instrument_interface
+            instrument_interface(interface, options.recorder)
+
+        for keyword in keywords:
+            interface.add_keyword(keyword)
+        in_background(worker, notetaker.backfill_keywords, "backfill",
+                        interface)
+        in_background(worker, notetaker.purge_deleted, "purge", interface)
+        worker.submit(notetaker.get_topics, done=interface.show_topics,
+                        key="topics")
+        interface.update()
+        mark("first screen")
+        interface.handle_events()
+    finally:
+        worker.stop()
+
+def update_notes(interface, notetaker, worker, **kwargs):
+    """Queue the database work for whatever the interface asked for, and a
+    check for changes, on the worker; the interface is updated as the
+    results come back. Requests of the same kind that haven't started yet
+    are replaced by the latest one."""
+    for key, job in stalled_jobs.items():
+        del stalled_jobs[key]
+        in_background(worker, job, key, interface)
     if "delete" in kwargs:
-        notetaker.delete_note(kwargs["delete"])
+        worker.submit(notetaker.delete_notes, (kwargs["delete"],),
+                        error=reporter(interface, "Deleting"))
+    if "restore" in kwargs:
+        worker.submit(notetaker.restore_notes, (kwargs["restore"],),
+                        error=reporter(interface, "Undoing the delete"))
+    if "mark_range" in kwargs:
+        first, last = kwargs["mark_range"]
+        worker.submit(notetaker.note_ids, (), {'first': first, 'last': last},
+                        done=interface.mark_ids)
+    if "mark_topic" in kwargs:
+        worker.submit(notetaker.note_ids, (), {'topic': kwargs["mark_topic"]},
+                        done=interface.mark_ids)
+    if "related" in kwargs:
+        worker.submit(notetaker.related_notes, (kwargs["related"],),
+                        done=interface.show_related, key="related")
+    if "search" in kwargs:
+        query = kwargs["search"]
+        worker.submit(notetaker.search, (query,),
+            done=lambda results: interface.show_results(query, results),
+            key="search")
+    worker.submit(notetaker.get_changes,
+        done=lambda changes: show_changes(interface, notetaker, worker,
+                                            changes), key="changes")
 
-    for note in notetaker.get_new_notes(interface.index_count):
+def show_changes(interface, notetaker, worker, changes):
+    if changes is None:
+# The note log no longer goes back far enough to say what changed:
+        interface.reload()
+        in_background(worker, notetaker.backfill_keywords, "backfill",
+                        interface)
+        worker.submit(notetaker.get_topics, done=interface.show_topics,
+                        key="topics")
+        return
+    notes, deleted = changes
+    for note_id in deleted:
+        interface.remove_note(note_id)
+    for note in notes:
         interface.insert_note(note)
-    interface.update()
+# New notes may have brought in new keywords, and any change may have changed
+# the topic counts:
+    if notes:
+        in_background(worker, notetaker.backfill_keywords, "backfill",
+                        interface)
+    if notes or deleted:
+        worker.submit(notetaker.get_topics, done=interface.show_topics,
+                        key="topics")
+
+def reporter(interface, what):
+    """An error callback for Worker.submit that says on the status line that
+    what failed, rather than the error ending the interface."""
+    return lambda exc_info: interface.report("%s failed: %s" % (what,
+                                                                exc_info[1]))
+
+# The background jobs (see in_background) whose last batch failed, by key,
+# to be started again after the next key or change:
+stalled_jobs = {}
+
+def in_background(worker, job, key, interface):
+    """Run a job that works in batches, job(1) doing one and returning
+    whether there's more (e.g. Noter.backfill_keywords, which links older
+    notes to new keywords), on the worker until it's done, queueing each
+    batch once the last is done so that whatever the interface asks for in
+    between goes first. A batch that fails (e.g. because another process
+    held the database for longer than the busy timeout) is reported on the
+    status line and the job carries on after the next key or change."""
+    def done(more):
+        if more:
+            in_background(worker, job, key, interface)
+
+    def error(exc_info):
+        stalled_jobs[key] = job
+        interface.report("The %s failed, trying again later: %s" % (key,
+                                                                exc_info[1]))
+    worker.submit(job, (1,), done=done, key=key, error=error)
 
 def init_interface(options):
     """Initialise the curses screen and pass the screen generated by
     curses.wrapper to load_interface."""
+    import curses
+    import traceback
+    mark("import curses")
     try:
         curses.wrapper( lambda scr: load_interface(scr, options) )
     except Exception:
@@ -106,13 +319,172 @@ def init_interface(options):
         print tb
 
 
+def import_notes(options):
+    """Stream the notes from the file given with --import into the database,
+    reporting progress and throughput on stderr as each batch is written."""
+    notetaker = open_noter(options)
+    start = time.time()
+
+    def progress(count):
+        elapsed = max(time.time() - start, 1e-6)
+        sys.stderr.write("\rImported %d notes (%.0f notes/s)" %
+                            (count, count / elapsed))
+        sys.stderr.flush()
+
+    f = open_input(options.import_path)
+    try:
+        try:
+            count = notetaker.import_notes(read_records(f),
+                topics=options.topics, batch_size=options.batch_size,
+                progress=progress)
+        except (IOError, ValueError), e:
+            sys.stderr.write("\nImport stopped: %s\n" % (e,))
+            raise SystemExit(1)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    if count:
+        sys.stderr.write("\n")
+    sys.stderr.write("Done: %d notes in %.1fs\n" % (count,
+                                                     time.time() - start))
+
+def backfill_keywords(options):
+    """Run the keyword backfill to the end, reporting progress on stderr;
+    stopping it part way loses at most the batch in progress."""
+    notetaker = open_noter(options)
+    pending = notetaker.pending_backfill()
+    if not pending:
+        sys.stderr.write("Nothing to backfill.\n")
+        return
+    sys.stderr.write("Backfilling %d keywords\n" % (pending,))
+
+    def progress(keyword, linked, position):
+        keyword = keyword.encode("utf-8")
+        if position:
+            sys.stderr.write("\r%s: %d notes linked, checking below #%d " %
+                                (keyword, linked, position))
+        else:
+            sys.stderr.write("\r%s: %d notes linked%s\n" % (keyword, linked,
+                                                            " " * 30))
+        sys.stderr.flush()
+
+    try:
+        notetaker.backfill_keywords(progress=progress)
+    except KeyboardInterrupt:
+        sys.stderr.write("\nStopped; run --backfill again to carry on.\n")
+        raise SystemExit(1)
+
+def reindex_keywords(options):
+    """Rebuild the keyword links, reporting progress and throughput on
+    stderr."""
+    notetaker = open_noter(options)
+    start = time.time()
+
+    def progress(done, total):
+        elapsed = max(time.time() - start, 1e-6)
+        sys.stderr.write("\rReindexed %d of %d notes (%.0f notes/s)" %
+                            (done, total, done / elapsed))
+        sys.stderr.flush()
+
+    try:
+        count = notetaker.reindex_keywords(processes=options.jobs,
+                                            progress=progress)
+    except KeyboardInterrupt:
+        sys.stderr.write("\nStopped; run --reindex again to carry on.\n")
+        raise SystemExit(1)
+    if count:
+        sys.stderr.write("\n")
+    sys.stderr.write("Done: %d notes in %.1fs\n" % (count,
+                                                     time.time() - start))
+
+def export_notes(options):
+    """Stream the notes out in the format given with --export."""
+    try:
+        since = parse_due_date(options.since)
+    except ValueError, e:
+        sys.stderr.write("--since: %s\n" % (e,))
+        raise SystemExit(1)
+    notetaker = open_noter(options)
+    f = open_output(options.output_path)
+    try:
+        writers[options.export_format](notetaker.export_notes(
+            topics=options.topics, since=since), f)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def add_note(options, body):
+    """Add the note through the daemon if one is running, otherwise
+    straight to the database."""
+    try:
+        send_request(options.socket_path, {"op": "add", "body": body,
+            "topics": options.topics, "due_date": options.due_date,
+            "db_path": options.db_path})
+        mark("add note through daemon")
+    except DaemonUnavailable:
+        mark("look for daemon")
+        notetaker = open_noter(options)
+        notetaker.add_note(body, topics=options.topics,
+                            due_date=options.due_date)
+        mark("add note")
+    except DaemonError, e:
+        sys.stderr.write("Could not add note: %s\n" % (e,))
+        raise SystemExit(1)
+
+def serve(options):
+    """Run the daemon until it's stopped."""
+    import socket
+    from lownote.daemon import serve
+    mark("import lownote.daemon")
+    try:
+        serve(open_noter(options), options.socket_path)
+    except (IOError, socket.error), e:
+        sys.stderr.write("Could not serve: %s\n" % (e,))
+        raise SystemExit(1)
+
 def main():
     options, body = get_args()
+    mark("read options and rc file")
+    options.recorder = None
+    instrument_path = None
+    if options.instrument:
+        from lownote.instrument import Recorder, dump_path
+        instrument_path = dump_path(options.instrument)
+        if instrument_path is not None:
+            options.recorder = Recorder()
+    try:
+        run(options, body)
+    finally:
+        if options.startup_profile:
+            report_startup()
+        if options.recorder is not None:
+            options.recorder.dump(instrument_path)
+
+def run(options, body):
+    if options.serve:
+        serve(options)
+        return
     
+    if options.export_format:
+        export_notes(options)
+        return
+
+    if options.backfill:
+        backfill_keywords(options)
+        return
+
+    if options.reindex:
+        reindex_keywords(options)
+        return
+
+    if options.import_path:
+        import_notes(options)
+        if options.interactive:
+            init_interface(options)
+        return
+
     if body:
-        notetaker = Noter(options.db_path)
-        notetaker.add_note(body, topics=options.topics,
-                            due_date=options.due_date)
+        add_note(options, body)
     else:
         init_interface(options)
 
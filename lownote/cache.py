@@ -0,0 +1,37 @@
+"""A small bounded cache for things that are expensive to load but cheap to
+keep around for a while, like fully loaded notes."""
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Dictionary-like cache holding at most size items; when it's full the
+    least recently used item makes way for the new one."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def discard(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
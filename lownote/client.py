@@ -0,0 +1,41 @@
+"""Talking to a running lownote daemon (see lownote.daemon). This is kept
+apart from the daemon itself so that sending a note to it only needs the
+socket and json modules, not the server or database code."""
+import json
+import socket
+
+class DaemonUnavailable(Exception):
+    """Nothing is listening on the socket, so the caller should go to the
+    database itself."""
+
+class DaemonError(Exception):
+    """The daemon got the request but couldn't carry it out."""
+
+def send_request(socket_path, request, timeout=30):
+    """Send one request to the daemon and return its response. Raises
+    DaemonUnavailable if there's no daemon to connect to; any failure after
+    that is raised as it is, as the daemon may already have acted on the
+    request and trying again elsewhere could do it twice."""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except socket.error, e:
+        sock.close()
+        raise DaemonUnavailable(e)
+    try:
+        sock.sendall(json.dumps(request) + "\n")
+        f = sock.makefile("rb")
+        line = f.readline()
+        f.close()
+    finally:
+        sock.close()
+    if not line:
+        raise DaemonError("The daemon closed the connection.")
+    response = json.loads(line)
+    if response.get("wrong_db"):
+        raise DaemonUnavailable(response["error"])
+    if not response.get("ok"):
+        raise DaemonError(response.get("error", "Unknown error."))
+    return response
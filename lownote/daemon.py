@@ -0,0 +1,178 @@
+"""A long-running lownote process (lownote --serve) that keeps a Noter, and
+so its mappers and keyword matcher, warm and answers requests over a Unix
+socket. The client side, which the command line uses to talk to it, is in
+lownote.client.
+
+The protocol is one JSON object per line each way. A request has an "op"
+and its arguments:
+    {"op": "add", "body": "...", "topics": [...], "due_date": "YYYYMMDD"}
+    {"op": "delete", "id": 12}  (or "ids": [12, 13, ...])
+    {"op": "restore", "ids": [12, 13, ...]}
+    {"op": "search", "query": "...", "limit": 100}
+    {"op": "related", "id": 12, "limit": 10}
+    {"op": "ping"}
+and every response has "ok", which is false with an "error" message when
+the request couldn't be carried out. A request can also name the "db_path"
+it's meant for, and a daemon serving a different database turns it away (as
+"wrong_db") so the client can go to that database itself. Any number of
+requests can be sent over one connection.
+
+Whenever there are no requests waiting, the daemon links older notes to any
+new keywords (see Noter.backfill_keywords) and removes notes deleted long
+enough ago for good (see Noter.purge_deleted), a batch at a time."""
+import json
+import os
+import signal
+import SocketServer
+import sys
+from lownote.model import NoteRow
+from lownote.client import send_request, DaemonUnavailable
+
+def _row(row):
+    return {"id": row.id, "date": row.date and row.date.isoformat(),
+            "preview": row.preview}
+
+def handle_request(notetaker, request):
+    """Carry out one request against the Noter and return the response."""
+
+    db_path = request.get("db_path")
+    if db_path is not None and \
+            os.path.realpath(db_path) != os.path.realpath(notetaker.db_path):
+        return {"ok": False, "wrong_db": True,
+                "error": "This daemon serves %s" % (notetaker.db_path,)}
+
+    notetaker.refresh()
+    op = request.get("op")
+    if op == "ping":
+        return {"ok": True}
+    if op == "add":
+# Checked before the Noter starts on the note, so a bad request can't leave
+# half a note behind:
+        body = request["body"]
+        due_date = request.get("due_date")
+        topics = request.get("topics") or []
+        if not isinstance(body, basestring):
+            raise ValueError("body must be a string")
+        if due_date is not None and not isinstance(due_date, basestring):
+            raise ValueError("due_date must be a string")
+        if not isinstance(topics, list) or \
+                not all(isinstance(x, basestring) for x in topics):
+            raise ValueError("topics must be a list of strings")
+        note_id = notetaker.add_note(body, due_date=due_date, topics=topics)
+        return {"ok": True, "id": note_id}
+    if op == "delete":
+        if "ids" in request:
+            notetaker.delete_notes([int(x) for x in request["ids"]])
+        else:
+            notetaker.delete_note(NoteRow(int(request["id"]), None, None))
+        return {"ok": True}
+    if op == "restore":
+        notetaker.restore_notes([int(x) for x in request["ids"]])
+        return {"ok": True}
+    if op == "search":
+        results = notetaker.search(request["query"],
+                                    limit=int(request.get("limit", 100)))
+        return {"ok": True, "notes": [dict(_row(row), snippet=snippet)
+                                        for row, snippet in results]}
+    if op == "related":
+        note = NoteRow(int(request["id"]), None, None)
+        rows = notetaker.related_notes(note,
+                                        limit=int(request.get("limit", 10)))
+        return {"ok": True, "notes": [_row(x) for x in rows]}
+    return {"ok": False, "error": "Unknown op: %r" % (op,)}
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+# readline rather than iterating over rfile, which reads ahead and would sit
+# waiting for more than the one request a client sends before it wants the
+# response.
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("A request must be a JSON object.")
+                response = handle_request(self.server.notetaker, request)
+            except Exception, e:
+# Whatever the request got as far as mustn't be committed by the next one:
+                self.server.notetaker.rollback()
+                if isinstance(e, (KeyError, ValueError, TypeError)):
+                    response = {"ok": False,
+                                "error": "Bad request: %s" % (e,)}
+                else:
+                    response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class NoteServer(SocketServer.UnixStreamServer):
+    """Requests are handled one at a time in the one thread, so the single
+    Noter (and its session) is never used by two requests at once; each
+    request is a few milliseconds of SQLite work at most."""
+
+    def __init__(self, socket_path, notetaker):
+        self.notetaker = notetaker
+        # Whether there's background work (see handle_timeout) left:
+        self.pending = True
+        _claim_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _Handler)
+        os.chmod(socket_path, 0600)
+
+    def handle_timeout(self):
+        """No requests came in: do a batch of the keyword backfill or, once
+        that's done, of purging deleted notes."""
+        try:
+            self.pending = self.notetaker.backfill_keywords(batches=1) or \
+                self.notetaker.purge_deleted(batches=1)
+        except Exception, e:
+# E.g. another process held the database for longer than the busy timeout;
+# it's tried again after the next request.
+            sys.stderr.write("Background work failed: %s\n" % (e,))
+            self.pending = False
+
+    def serve_until_stopped(self):
+        """Like serve_forever, but only waits for a request once there's no
+        background work left; any request (e.g. an add) may have brought in
+        new keywords, so that's checked again after every one."""
+        while True:
+            if self.pending:
+                self.timeout = 0
+            else:
+                self.timeout = None
+            self.handle_request()
+            if self.timeout is None:
+                self.pending = bool(self.notetaker.pending_backfill() or
+                                    self.notetaker.pending_purge())
+
+def _claim_socket(socket_path):
+    """Remove the socket left behind by a daemon that didn't exit cleanly,
+    but refuse to start if a daemon is still answering on it."""
+
+    if not os.path.exists(socket_path):
+        return
+    try:
+        send_request(socket_path, {"op": "ping"}, timeout=2)
+    except DaemonUnavailable:
+        os.unlink(socket_path)
+    else:
+        raise IOError("A daemon is already listening on %s" % (socket_path,))
+
+def _stop():
+    raise KeyboardInterrupt
+
+def serve(notetaker, socket_path):
+    """Answer requests on the socket until interrupted or terminated."""
+
+    server = NoteServer(socket_path, notetaker)
+    signal.signal(signal.SIGTERM, lambda signum, frame: _stop())
+    try:
+        try:
+            server.serve_until_stopped()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
@@ -0,0 +1,180 @@
+"""Opt-in instrumentation, for finding out where the time goes when the
+interface stutters. It's turned on with "instrument" in the rc file or the
+LOWNOTE_INSTRUMENT environment variable (yes/true/1, or the path of the file
+to dump the results to). When it's off none of this is even imported; when
+it's on, the Noter's methods, the SQL statements it runs and the interface's
+drawing and callback are wrapped per instance to record:
+    * a latency histogram for every operation;
+    * the number of SQL statements every operation ran (including the ones
+      run by any operation it called);
+and the results are written out as JSON on exit."""
+import inspect
+import json
+import os
+import threading
+import time
+
+default_path = "~/.lownote/instrument.json"
+
+def dump_path(setting):
+    """Turn the instrument setting (from the command line, environment or rc
+    file) into the path to dump to, or None if instrumentation is off."""
+    if setting in (None, False, "") or str(setting).lower() in ("0", "no",
+            "false", "off"):
+        return None
+    if setting is True or str(setting).lower() in ("1", "yes", "true", "on"):
+        return os.path.expanduser(default_path)
+    return os.path.expanduser(setting)
+
+class Histogram(object):
+    """Latencies bucketed by powers of two microseconds, which is plenty to
+    tell a 50us call from a 5ms one in a fixed, small amount of space."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        """The upper bound (in seconds) of the bucket the given fraction of
+        calls fall within."""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.count:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p90_ms": self.percentile(0.9) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max * 1000,
+            "buckets": dict(("<%dus" % (1 << x,), n)
+                            for x, n in self.buckets.iteritems()),
+        }
+
+class Recorder(object):
+    """Collects the timings. Operations can nest (e.g. get_note calls
+    preload); every SQL statement counts towards each operation it ran
+    within on the same thread."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.statements = {}
+        self.local = threading.local()
+        # The latest (seconds, statements) of each operation, for the
+        # status line:
+        self.last = {}
+
+    def wrap(self, name, func):
+        """Return func wrapped to record its latency under name."""
+        histogram = self.histograms.setdefault(name, Histogram())
+
+        def wrapper(*args, **kwargs):
+            frame = [0]
+            stack = self.stack()
+            stack.append(frame)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                stack.pop()
+                histogram.add(elapsed)
+                self.statements[name] = \
+                    self.statements.get(name, 0) + frame[0]
+                self.last[name] = (elapsed, frame[0])
+        wrapper.__name__ = getattr(func, "__name__", name)
+        wrapper.__doc__ = getattr(func, "__doc__", None)
+        return wrapper
+
+    def stack(self):
+        """The operations running on this thread, outermost first."""
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def count_statement(self):
+        stack = self.stack()
+        if not stack:
+            self.statements["(outside any operation)"] = \
+                self.statements.get("(outside any operation)", 0) + 1
+        for frame in stack:
+            frame[0] += 1
+
+    def status(self):
+        """One line on the latest frame, for the interface's status line."""
+        parts = []
+        for name in ("key", "update_notes", "display_note", "flush"):
+            if "interface." + name in self.last:
+                seconds, statements = self.last["interface." + name]
+                part = "%s %.1fms" % (name, seconds * 1000)
+                if statements:
+                    part += " %dsql" % (statements,)
+                parts.append(part)
+        return " | ".join(parts)
+
+    def report(self):
+        operations = {}
+        for name, histogram in self.histograms.iteritems():
+            if not histogram.count:
+                continue
+            summary = histogram.summary()
+            summary["statements"] = self.statements.get(name, 0)
+            summary["statements_per_call"] = \
+                float(summary["statements"]) / histogram.count
+            operations[name] = summary
+        return {"operations": operations,
+                "statements_outside": self.statements.get(
+                    "(outside any operation)", 0)}
+
+    def dump(self, path):
+        f = open(path, "w")
+        json.dump(self.report(), f, indent=2, sort_keys=True)
+        f.close()
+
+def instrument_noter(notetaker, recorder):
+    """Wrap the Noter's public methods and its engine's statement execution.
+    Generators (e.g. get_notes) are left alone as timing them would only
+    time making the generator."""
+    for name, method in inspect.getmembers(notetaker, inspect.ismethod):
+        if name.startswith("_") or inspect.isgeneratorfunction(method):
+            continue
+        setattr(notetaker, name, recorder.wrap("noter." + name, method))
+
+    dialect = notetaker.engine.dialect
+    for name in ("do_execute", "do_executemany"):
+        def counted(cursor, statement, parameters, context=None,
+                    execute=getattr(dialect, name)):
+            recorder.count_statement()
+            return execute(cursor, statement, parameters, context=context)
+        setattr(dialect, name, counted)
+
+def instrument_interface(interface, recorder):
+    """Wrap the interface's redraws and flushes to the terminal, note
+    display, key handlers and callback; a frame is one key handler plus the
+    callback after it."""
+    interface.update = recorder.wrap("interface.update", interface.update)
+    interface.flush = recorder.wrap("interface.flush", interface.flush)
+    display = interface.note_display
+    display.display_note = recorder.wrap("interface.display_note",
+                                         display.display_note)
+    if interface.callback is not None:
+        interface.callback = recorder.wrap("interface.update_notes",
+                                           interface.callback)
+    for key, handler in interface.keys_dispatch.items():
+        interface.keys_dispatch[key] = recorder.wrap("interface.key", handler)
@@ -6,9 +6,13 @@ topics attributes (this may not be an exhaustive list)>
 """
 
 import curses
+import errno
 import re
+import select
 import textwrap
 from lownote.keys import keys 
+from lownote.matcher import KeywordMatcher
+from lownote.cache import LRUCache
 
 class Window(object):
     """Base class to wrap curses window functionality, should be inherited to
@@ -41,9 +45,29 @@ class Window(object):
         self.x = x
         self.fg = "W"
         self.bg = None
+        self.staged = False
 
     def update(self):
-        self.window.refresh()
+        """Stage the lines of the window that have changed; nothing reaches
+        the terminal until the interface flushes (see Interface.flush), so
+        a key that redraws several windows costs one write."""
+        self.window.noutrefresh()
+        self.staged = True
+
+    def place(self, y, x, height, width):
+        """Move and resize the window, e.g. after the terminal's been
+        resized; what's in it has to be drawn again (see redraw)."""
+# Resizing first, as mvwin() refuses to put any of the old size off screen:
+        self.window.resize(height, width)
+        self.window.mvwin(y, x)
+        self.y = y
+        self.x = x
+        self.height = height
+        self.width = width
+
+    def redraw(self):
+        self.window.touchwin()
+        self.update()
 
     def echo_colour(self, string, fg, bg, pad=False, center=False):
         if center:
@@ -55,15 +79,15 @@ class Window(object):
             pad_len = self.width - x - len(string) 
             string += " " * pad_len
 
-        if bg is None:
-            attr = curses.color_pair(self.colours[fg] + 1)
-        else:
-            attr = curses.color_pair(
-                (self.colours[bg] * 8) + self.colours[fg] + 1
-                )
         self.fg = fg
         self.bg = bg
-        self.window.addstr(string, attr)
+        self.window.addstr(string, self.attr(fg, bg))
+
+    def attr(self, fg, bg=None):
+        """The curses attribute for the colour pair (see make_colours)."""
+        if bg is None:
+            return curses.color_pair(self.colours[fg] + 1)
+        return curses.color_pair((self.colours[bg] * 8) + self.colours[fg] + 1)
 
     def echo(self, string, pad=False, center=False):
         if '\n' in string:
@@ -88,14 +112,17 @@ class Window(object):
         # Grab "\x03XX\x03foobarbaz" strings - the lookahead assert is
         # necessary to make it match up to the next \x03 or $ without actually
         # grabbing it (which would skip the next match):
-        for section in re.findall("\x03([a-zA-Z][a-zA-Z]?)\x03(.*?)(?=(?:\x03|$))",
-                                        string):
+        sections = re.findall("\x03([a-zA-Z][a-zA-Z]?)\x03(.*?)(?=(?:\x03|$))",
+                                        string)
+        for i, section in enumerate(sections):
             fg = section[0][0].upper()
             bg = None
             if len(section[0]) == 2:
                 bg = section[0][1].upper()
 
-            self.echo_colour(section[1], fg, bg, pad, center)
+# Only the last section pads out the rest of the line:
+            last = i == len(sections) - 1
+            self.echo_colour(section[1], fg, bg, pad and last, center)
 
     def insert_line(self, string, x, pad=False, center=False):
         self.window.move(x - self.scrolling + 1, 0)
@@ -119,14 +146,61 @@ class Window(object):
         return "\n".join(lines)
 
 
+def wrap_slices(text, width):
+    """Wrap the text to the width and return each line as a (start, end)
+    slice of it, so that anything marked against positions in the text (like
+    keyword matches) can be carried over to the wrapped lines. Lines break
+    between words, or inside words too long for a line of their own, and at
+    every newline in the text."""
+    lines = []
+    start = 0
+    for paragraph in text.split("\n"):
+        line_start = None
+        end = start
+        for word in re.finditer(r"\S+", paragraph):
+            word_start, word_end = start + word.start(), start + word.end()
+            if line_start is None:
+                line_start = word_start
+            elif word_end - line_start > width:
+                lines.append((line_start, end))
+                line_start = word_start
+            while word_end - line_start > width:
+                lines.append((line_start, line_start + width))
+                line_start += width
+            end = word_end
+        if line_start is None:
+            lines.append((start, start))
+        else:
+            lines.append((line_start, end))
+        start += len(paragraph) + 1
+    return lines
+
 class MainWindow(Window):
+    """Displays a note. Putting a note on screen happens in two stages: the
+    layout stage highlights and wraps the note into lines of (text,
+    attribute) runs, and the output stage writes those runs out. Layouts are
+    kept in a bounded cache keyed by note id and checked against the width
+    and the keyword matcher's version, so going back to a note already seen
+    only costs the output stage."""
+
+    # The number of note layouts to keep:
+    layout_cache_size = 100
+
     def __init__(self, y, x, height, width):
-        super(MainWindow, self).__init__(y, x+1, height, width)
+        # The seperator takes the first column:
+        super(MainWindow, self).__init__(y, x+1, height, width-1)
+        self.layouts = LRUCache(self.layout_cache_size)
+        # The note and keywords last displayed, to draw again on a resize:
+        self.shown = None
         self.seperator = Window(y, x, height, 1)
         self.seperator.window.attrset(
             curses.color_pair(self.colours["B"] + 1)
             )
-        self.seperator.window.vline(curses.ACS_VLINE, height)
+        self.draw_seperator()
+
+    def draw_seperator(self):
+        self.seperator.window.erase()
+        self.seperator.window.vline(curses.ACS_VLINE, self.height)
 
     def hard_update(self):
         self.window.touchwin()
@@ -136,113 +210,553 @@ class MainWindow(Window):
         super(MainWindow, self).update()
         self.seperator.update()
 
-    def display_note(self, note, keywords):
+    def place(self, y, x, height, width):
+        super(MainWindow, self).place(y, x+1, height, width-1)
+        self.seperator.place(y, x, height, 1)
+
+    def redraw(self):
+        self.draw_seperator()
+        if self.shown is None:
+            self.blank()
+        else:
+            self.display_note(*self.shown)
+
+    def blank(self):
+        self.shown = None
         self.clear()
-        self.echo("\x03Y\x03Note made on: \x03G\x03%s\n"
-                % note.date.strftime("%c"))
+        self.update()
+
+    def display_note(self, note, keywords):
+        self.shown = (note, keywords)
+        stamp = (self.width, keywords.version)
+        cached = self.layouts.get(note.id)
+        if cached is not None and cached[0] == stamp:
+            lines = cached[1]
+        else:
+            lines = self.layout_note(note, keywords)
+            self.layouts.put(note.id, (stamp, lines))
+        self.draw_lines(lines)
+        self.update()
+
+    def forget(self, note_id=None):
+        """Drop the cached layout for a note, e.g. once it's deleted, or all
+        of them."""
+        if note_id is None:
+            self.layouts.clear()
+        else:
+            self.layouts.discard(note_id)
+
+    def layout_note(self, note, keywords):
+        """Return the lines for the note as lists of (text, attr) runs, with
+        the body wrapped to the width and every keyword coloured, from one
+        pass of the keyword matcher (see Interface.add_keyword) over it."""
+        yellow, green, red, blue = [self.attr(x) for x in "YGRB"]
+        lines = [[("Note made on: ", yellow),
+                    (note.date.strftime("%c"), green)]]
         if note.topics:
-            topics_string = ", ".join(x.topic for x in note.topics)
+            lines.append([("Listed under topics: ", yellow),
+                    (", ".join(note.topics), green)])
         else:
-            topics_string = "\x03b\x03[None]"
-        self.echo("\x03Y\x03Listed under topics: \x03G\x03%s\n"
-                % (topics_string,))
+            lines.append([("Listed under topics: ", yellow),
+                    ("[None]", blue)])
+
         body = note.body
-        for keyword in keywords:
-            body = re.sub("(?i)(%s)" % (keyword,),
-                '\x03R\x03\\1\x03B\x03', body)
-        body = self.wrap(body)
+        matches = keywords.highlight(body)
+        match = 0
+        for start, end in wrap_slices(body, self.width - 1):
+            runs = []
+            while match < len(matches) and matches[match][1] <= start:
+                match += 1
+# Walk the keyword matches overlapping this line; a match can be split over
+# two lines when a long word is broken up:
+            i = match
+            position = start
+            while i < len(matches) and matches[i][0] < end:
+                match_start = max(matches[i][0], start)
+                match_end = min(matches[i][1], end)
+                if match_start > position:
+                    runs.append((body[position:match_start], blue))
+                runs.append((body[match_start:match_end], red))
+                position = match_end
+                i += 1
+            if end > position:
+                runs.append((body[position:end], blue))
+            lines.append(runs)
+        return lines
+
+    def draw_lines(self, lines):
+        """Write out a layout from the top of the window, as much of it as
+        fits."""
+        self.clear()
+        for y, runs in enumerate(lines[:self.height]):
+            self.window.move(y, 0)
+            try:
+                for text, attr in runs:
+                    self.window.addstr(text, attr)
+            except curses.error:
+# Filling the bottom right cell leaves the cursor outside the window:
+                pass
+
+class RelatedWindow(MainWindow):
+    """The pane under the note display listing the notes related to the
+    selected note, one per line."""
+
+    def __init__(self, y, x, height, width):
+        super(RelatedWindow, self).__init__(y, x, height, width)
+        self.show_notes([])
+
+    def redraw(self):
+        self.draw_seperator()
+        self.show_notes(self.notes)
+
+    def show_notes(self, notes):
+        self.notes = notes
+        self.clear()
+        self.echo("\x03BR\x03Related notes:", pad=True, center=True)
+        if not notes:
+            self.echo("\x03b\x03[None]")
+        for i, note in enumerate(notes[:self.height - 1]):
+            if i:
+                self.window.addstr("\n")
+            self.echo("\x03G\x03" +
+                        note.preview.replace("\n", " ")[:self.width - 1])
+        self.update()
+
+class StatusWindow(Window):
+    """A single line along the bottom of the screen, e.g. for the
+    instrumentation's timings (see lownote.instrument)."""
 
-        self.echo("\x03B\x03%s" % body)
+    def __init__(self, y, x, width):
+        super(StatusWindow, self).__init__(y, x, 1, width)
+        self.window.scrollok(False)
+        self.text = ""
+
+    def redraw(self):
+        self.show(self.text)
+
+    def show(self, text):
+        self.text = text
+        self.window.move(0, 0)
+        try:
+            self.echo("\x03KW\x03" + text[:self.width], pad=True)
+        except curses.error:
+# Padding to the bottom right cell leaves the cursor outside the window:
+            pass
         self.update()
 
+    def hard_update(self):
+        self.window.touchwin()
+
 class IndexWindow(Window):
+    """The list of notes down the left hand side. Only the rows that fit on
+    screen are ever drawn, and only a few pages of notes around them are
+    held in self.notes; the pager (see set_source) is asked for more as the
+    selection moves past either end, so neither startup nor scrolling
+    depends on how many notes there are. self.top is the index in self.notes
+    of the first row on screen. Marks are kept by note id in self.marked, so
+    notes stay marked as they're paged out and back in again."""
+
     def __init__(self, y, x, height, width):
         super(IndexWindow, self).__init__(y, x, height, width)
+        # Rows are drawn right up to the bottom right corner, which must not
+        # scroll the window:
+        self.window.scrollok(False)
         self.notes = []
-        self.last_selected = self.selected = -1
+        self.previews = {}
+        self.title = "Notes:"
+        self.pager = None
+        self.at_start = self.at_end = True
+        self.top = 0
+        self.selected = -1
+        self.marked = set()
         self.echo_title()
 
+    @property
+    def rows(self):
+        """The number of notes that fit under the title."""
+        return self.height - 1
+
+    @property
+    def page_size(self):
+        return max(self.rows * 2, 50)
+
     def echo_title(self):
-        self.echo("\x03BR\x03Notes:", pad=True, center=True)
+        self.window.move(0, 0)
+        self.echo("\x03BR\x03" + self.title[:self.width], pad=True,
+                    center=True)
+
+    def prompt(self, prompt):
+        """Read a line of input on the bottom row of the window and return
+        it; the window needs to be redrawn afterwards."""
+        curses.echo()
+        curses.curs_set(1)
+        self.window.move(self.height - 1, 0)
+        self.window.clrtoeol()
+        self.echo_colour(prompt, "Y", None)
+        try:
+            string = self.window.getstr(self.height - 1, len(prompt),
+                                        self.width - len(prompt) - 1)
+        finally:
+            curses.noecho()
+            curses.curs_set(0)
+        return string.strip()
+
+    def set_source(self, pager, title="Notes:"):
+        """List the notes returned by the pager, which is called as
+        pager(before=id, after=id, limit=n) and must return up to n notes,
+        newest first, that are older than before or newer than after (the
+        newest notes if neither is given)."""
+        self.pager = pager
+        self.previews = {}
+        self.title = title
+        self.notes = list(pager(limit=self.page_size))
+        self.at_start = True
+        self.at_end = len(self.notes) < self.page_size
+        self.top = 0
+        self.selected = -1
+        self.repopulate()
+
+    def set_notes(self, notes, title, previews=None):
+        """Swap the whole listing for a fixed list of notes, e.g. a set of
+        search results; previews maps note ids to the text to list instead
+        of the body."""
+        self.pager = None
+        self.notes = list(notes)
+        self.previews = previews or {}
+        self.title = title
+        self.at_start = self.at_end = True
+        self.top = 0
+        self.selected = 0 if self.notes else -1
+        self.repopulate()
         
     def get_note_count(self):
         return len(self.notes)
 
+    def _shift(self, count):
+        """Move the viewport and selection by count rows after rows have been
+        added to or removed from the start of self.notes."""
+        self.top += count
+        if self.selected != -1:
+            self.selected += count
+
+    def fetch_older(self):
+        """Extend self.notes with the next page of older notes and return
+        whether there were any. When the buffer grows past a few pages the
+        rows furthest above the viewport are dropped."""
+        if self.at_end or self.pager is None:
+            return False
+        if self.notes:
+            notes = self.pager(before=self.notes[-1].id, limit=self.page_size)
+        else:
+            notes = self.pager(limit=self.page_size)
+        self.at_end = len(notes) < self.page_size
+        self.notes.extend(notes)
+
+        excess = min(len(self.notes) - self.page_size * 3, self.top)
+        if excess > 0:
+            del self.notes[:excess]
+            self._shift(-excess)
+            self.at_start = False
+        return bool(notes)
+
+    def fetch_newer(self):
+        """The same as fetch_older, the other way round."""
+        if self.at_start or self.pager is None or not self.notes:
+            return False
+        notes = self.pager(after=self.notes[0].id, limit=self.page_size)
+        self.at_start = len(notes) < self.page_size
+        self.notes[:0] = notes
+        self._shift(len(notes))
+
+        keep = max(self.page_size * 3, self.top + self.rows)
+        if len(self.notes) > keep:
+            del self.notes[keep:]
+            self.at_end = False
+        return bool(notes)
+
+    def scroll_to(self, index):
+        """Move the viewport so the row at index is on screen and return
+        whether it had to move."""
+        top = self.top
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.rows:
+            self.top = index - self.rows + 1
+        return top != self.top
+
+    def draw_row(self, index):
+        """Draw the row at index if it is on screen; rows past the end of the
+        list are drawn blank."""
+        line = index - self.top + 1
+        if not 0 < line <= self.rows:
+            return
+        self.window.move(line, 0)
+        self.window.clrtoeol()
+        if index >= len(self.notes):
+            return
+        try:
+            if index == self.selected:
+                self.echo_selected(self.notes[index])
+            else:
+                self.echo_note(self.notes[index])
+        except curses.error:
+# Filling the bottom right cell leaves the cursor outside the window, which
+# curses reports as an error even though the row was drawn:
+            pass
+
+    def draw_rows(self):
+        for index in xrange(self.top, self.top + self.rows):
+            self.draw_row(index)
+
     def repopulate(self):
         self.clear()
         self.echo_title()
-        for note in self.notes:
-            self.echo_note(note)
-        # This marks the current selection as dirty, so the selection will be
-        # redrawn, e.g. after deletion/insertion:
-        self.last_selected = -1
-        self.update()
-        
-    def append(self, note):
-        self.notes.append(note)
-        self.echo_note(note)
+        self.draw_rows()
         self.update()
 
+    def redraw(self):
+        """Fill the window again after it's been resized, keeping the
+        selection on screen."""
+        if len(self.notes) < self.top + self.rows:
+            self.fetch_older()
+        if self.selected != -1:
+            self.scroll_to(self.selected)
+        self.repopulate()
+
     def delete(self, x):
-        if not self.notes:
-            return
-        if len(self.notes) < x:
+        """Remove the row at x; only the rows below it on screen move, and
+        one new row is drawn at the bottom."""
+        if not 0 <= x < len(self.notes):
             return
         del self.notes[x]
-        if x <= len(self.notes):
+        if x < self.selected or self.selected == len(self.notes):
             self.selected -= 1
+        if x < self.top:
+            self.top -= 1
+            return
+
+        if len(self.notes) < self.top + self.rows:
+            self.fetch_older()
+        line = x - self.top + 1
+        if line <= self.rows:
+            self.window.move(line, 0)
+            self.window.deleteln()
+            self.draw_row(self.top + self.rows - 1)
+            self.draw_row(self.selected)
+            self.update()
+
+    def remove(self, ids):
+        """Remove every note with one of the ids (e.g. a bulk delete) and
+        draw the window once, rather than moving the rows up once per note
+        as delete() would. The selection moves on to the next note left."""
+        ids = set(ids)
+        self.marked -= ids
+        kept = [x for x in self.notes if x.id not in ids]
+        if len(kept) == len(self.notes):
+            return
+        top = len([x for x in self.notes[:self.top] if x.id not in ids])
+        if self.selected != -1:
+            self.selected = len([x for x in self.notes[:self.selected]
+                                 if x.id not in ids])
+        self.notes = kept
+        self.top = top
+        if len(self.notes) < self.top + self.rows:
+# The notes may not be deleted in the database yet:
+            self.fetch_older()
+            self.notes = [x for x in self.notes if x.id not in ids]
+        if self.selected >= len(self.notes):
+            self.selected = len(self.notes) - 1
+        self.top = max(min(self.top, len(self.notes) - self.rows), 0)
+        if self.selected != -1:
+            self.scroll_to(self.selected)
         self.repopulate()
 
+    def mark(self, ids, marked=True):
+        """Mark (or unmark) the notes with the ids, redrawing the rows of
+        those that are on screen."""
+        ids = set(ids)
+        if marked:
+            self.marked |= ids
+        else:
+            self.marked -= ids
+        for index in xrange(self.top, min(self.top + self.rows,
+                                          len(self.notes))):
+            if self.notes[index].id in ids:
+                self.draw_row(index)
+        self.update()
+
     def insert(self, note, x):
+        """Insert a note at x, pushing the rows below it on screen down a
+        line. A new note for the top of the list is left for fetch_newer if
+        the newest notes aren't currently held."""
+        if x == 0 and not self.at_start:
+            return
         self.notes.insert(x, note)
-        self.repopulate()
-        self.selected += 1
+        if x <= self.selected:
+            self.selected += 1
+        if x < self.top:
+            self.top += 1
+            return
+
+        if self.selected >= self.top + self.rows:
+# Keep the selected note on screen:
+            self.top += 1
+            self.draw_rows()
+        elif x - self.top < self.rows:
+            self.window.move(x - self.top + 1, 0)
+            self.window.insertln()
+            self.draw_row(x)
+        self.update()
+
+    def preview(self, note):
+        return self.previews.get(note.id, note.preview).replace("\n", " ")
 
     def echo_note(self, note):
-        self.echo('\x03G\x03' + note.body[:self.width], pad=True)
+        if note.id in self.marked:
+            preview = self.preview(note).replace('\x03G\x03', '\x03Y\x03')
+            self.echo('\x03Y\x03' + preview[:self.width], pad=True)
+        else:
+            self.echo('\x03G\x03' + self.preview(note)[:self.width],
+                      pad=True)
 
     def echo_selected(self, note):
-        self.echo('\x03KG\x03' + note.body[:self.width], pad=True)
+        colour = note.id in self.marked and 'KY' or 'KG'
+        preview = self.preview(note).replace('\x03G\x03',
+                                             '\x03%s\x03' % (colour,))
+        self.echo('\x03%s\x03' % (colour,) + preview[:self.width], pad=True)
 
     def up(self):
-        if not self.notes:
-            return
         if self.selected == 0:
-            return
-        
-        self.last_selected = self.selected
-        self.selected -= 1
-        self.update()
+            self.fetch_newer()
+        if self.selected > 0:
+            self.select(self.selected - 1)
+        elif self.selected == -1 and self.notes:
+            self.select(0)
 
     def down(self):
-        if not self.notes:
+        if self.selected + 1 >= len(self.notes):
+            self.fetch_older()
+        if self.selected + 1 < len(self.notes):
+            self.select(self.selected + 1)
+
+    def select(self, index):
+        """Move the selection to index, redrawing just the two rows involved
+        unless the viewport has to scroll."""
+        last_selected = self.selected
+        self.selected = index
+        if self.scroll_to(index):
+            self.draw_rows()
+        else:
+            self.draw_row(last_selected)
+            self.draw_row(index)
+        self.update()
+
+    def hard_update(self):
+        self.window.touchwin()
+
+class TopicWindow(Window):
+    """The pane above the index listing every topic with the number of notes
+    under it (see Noter.get_topics), after an "All notes" row; the index
+    lists the notes under the selected topic (see Interface.choose_topic)."""
+
+    def __init__(self, y, x, height, width):
+        super(TopicWindow, self).__init__(y, x, height, width)
+        self.window.scrollok(False)
+        self.topics = []
+        self.top = 0
+        self.selected = 0
+        self.focused = False
+        self.repopulate()
+
+    @property
+    def rows(self):
+        return self.height - 1
+
+    @property
+    def topic(self):
+        """The selected topic, or None for all notes."""
+        if self.selected == 0:
+            return None
+        return self.topics[self.selected - 1][0]
+
+    def show_topics(self, topics):
+        """List the topics, given as (topic, count) pairs, keeping the same
+        topic selected if it's still there."""
+        topic = self.topic
+        self.topics = list(topics)
+        self.selected = 0
+        for i, (name, count) in enumerate(self.topics):
+            if name == topic:
+                self.selected = i + 1
+        self.scroll_to(self.selected)
+        self.repopulate()
+
+    def scroll_to(self, index):
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.rows:
+            self.top = index - self.rows + 1
+
+    def draw_row(self, index):
+        line = index - self.top + 1
+        if not 0 < line <= self.rows:
             return
-        if len(self.notes) == self.selected + 1:
+        self.window.move(line, 0)
+        self.window.clrtoeol()
+        if index > len(self.topics):
             return
+        if index == 0:
+            text = "All notes"
+        else:
+            topic, count = self.topics[index - 1]
+            count = " %d" % (count,)
+            width = max(self.width - len(count), 0)
+            text = topic[:width].ljust(width) + count
+        colour = "G"
+        if index == self.selected:
+            colour = self.focused and "KG" or "KW"
+        try:
+            self.echo("\x03%s\x03" % (colour,) + text[:self.width], pad=True)
+        except curses.error:
+# Filling the bottom right cell leaves the cursor outside the window:
+            pass
 
-        self.last_selected = self.selected
-        self.selected += 1
+    def repopulate(self):
+        self.clear()
+        self.window.move(0, 0)
+        self.echo("\x03BR\x03" + "Topics:"[:self.width], pad=True,
+                    center=True)
+        for index in xrange(self.top, self.top + self.rows):
+            self.draw_row(index)
         self.update()
 
+    def redraw(self):
+        self.scroll_to(self.selected)
+        self.repopulate()
+
     def select(self, index):
-        if self.last_selected != -1:
-            self.clear_line(self.last_selected)
-            self.echo_note(self.notes[self.last_selected])
-        self.clear_line(self.selected)
-        self.echo_selected(self.notes[self.selected])
+        """Move the selection to index and return whether it moved."""
+        if not 0 <= index <= len(self.topics) or index == self.selected:
+            return False
+        self.selected = index
+        self.scroll_to(index)
+        self.repopulate()
+        return True
+
+    def up(self):
+        return self.select(self.selected - 1)
+
+    def down(self):
+        return self.select(self.selected + 1)
 
-# XXX: Might seem a bit weird, but update() checks for the difference and
-# redraws if last_selected and selected don't match:
-        self.last_selected = self.selected
+    def focus(self, focused):
+        self.focused = focused
+        self.draw_row(self.selected)
+        self.update()
 
     def hard_update(self):
         self.window.touchwin()
 
-    def update(self):
-        if self.selected != self.last_selected:
-            self.select(self.selected)
-        super(IndexWindow, self).update()
-
 class Interface(object):
     """Main interface class; provide methods for initialising the screen with
     the window setup (left column with list of notes/topics, larger right
@@ -251,6 +765,14 @@ class Interface(object):
     of drawing to the screen - just pass a string to the right method and let
     it handle it. Also handle screen resizing and keyboard input."""
 
+    # How many notes either side of the selection to load along with it:
+    nearby = 10
+    # How many deletes can be undone:
+    undo_limit = 20
+    # The smallest screen the windows are laid out on:
+    min_height = 8
+    min_width = 20
+
     def make_colours(self):
         curses.start_color()
         curses.use_default_colors()
@@ -259,37 +781,113 @@ class Interface(object):
             else: j = -1
             curses.init_pair(i+1, i % 8, j)
 
-    def __init__(self, scr, callback=None, timeout=500):
+    def __init__(self, scr, callback=None, timeout=500, pager=None,
+                    loader=None, status=None, watcher=None, worker=None):
         """Work out how big to draw the columns and initialise them as separate
         windows. The curses screen comes externally so the caller can deal with
         the curses wrapper in the main script. The callback specified is for
         any processing that needs to be done by the caller when the interface
         does something (i.e. when a user hits a key or the timeout is
-        reached)."""
+        reached). The pager is how the index fetches notes as it scrolls (see
+        IndexWindow.set_source), and it's also given topic=name to list the
+        notes under a topic from the topic pane; the listed notes only need
+        an id, date and preview, and the loader is called as loader(id,
+        nearby=ids) to get the full note when one is selected, nearby being
+        the ids of the notes around it, which are likely to be wanted next.
+        A line is kept along the bottom of the screen for messages (see
+        report) and, if status is given, filled with what status() returns
+        after every key and callback when there's no message. If
+        watcher is given (see lownote.watch) the callback is only run after a
+        key or once the watcher reports a change to the database, rather than
+        every timeout milliseconds. If worker is given (see lownote.worker)
+        the loader is run on it and the note shown once it's loaded, and the
+        worker's results are dispatched from the event loop; the callback is
+        then expected to hand its database work to the worker too."""
 
         self.make_colours()
         curses.curs_set(0)
         self.scr = scr
-        height, width = self.scr.getmaxyx()
         
         self.callback = callback
-        self.keywords = set()
-        index_width = int(width * 0.25)
-        main_width = width - index_width
+        self.keywords = KeywordMatcher()
+        self.status = status
+        layout = self.layout(*self.scr.getmaxyx())
 
-        self.note_index = IndexWindow(0, 0, height, index_width)
-        self.note_display = MainWindow(0, index_width, height, main_width)
-        self.note_display.window.timeout(timeout)
+        self.note_index = IndexWindow(*layout[0])
+        self.note_display = MainWindow(*layout[1])
+        self.related = RelatedWindow(*layout[2])
+        self.topic_pane = TopicWindow(*layout[3])
+        self.windows = [self.note_index, self.note_display, self.related,
+                        self.topic_pane]
+        y, x, height, width = layout[4]
+        self.status_line = StatusWindow(y, x, width)
+        self.windows.append(self.status_line)
+        # Shown on the status line until the next key (see report):
+        self.message = None
+        self.watcher = watcher
+        self.worker = worker
+        if watcher is None:
+            self.note_display.window.timeout(timeout)
+        else:
+# Keys are only read once select() says there are some (see wait):
+            self.note_display.window.timeout(0)
         self.update()
 
+        # The pane j and k move through (see switch_pane):
         self.selected = self.note_index
+        self.pager = pager
+        self.loader = loader
+        self.searching = False
+        # The ids of the notes removed by each delete, latest last, for undo:
+        self.deleted = []
+        # The note last marked or unmarked, where mark_range starts from:
+        self.anchor = None
+        if pager is not None:
+            self.note_index.set_source(pager)
 
         self.keys_dispatch = {
             keys['exit']: self.exit,
             keys['up']: self.up,
             keys['down']: self.down,
             keys['delete']: self.delete,
+            keys['undo']: self.undo,
+            keys['mark']: self.mark,
+            keys['mark_range']: self.mark_range,
+            keys['mark_topic']: self.mark_topic,
+            keys['clear_marks']: self.clear_marks,
+            keys['search']: self.search,
+            keys['switch_pane']: self.switch_pane,
+            'KEY_RESIZE': self.resize,
         }
+
+    def layout(self, height, width):
+        """Work out where the windows go on a screen of the given size, as
+        (y, x, height, width) for the index, note, related notes, topics
+        and status line."""
+        height -= 1
+        index_width = int(width * 0.25)
+        main_width = width - index_width
+        related_height = max(int(height * 0.25), 3)
+        main_height = height - related_height
+        topics_height = max(int(height * 0.3), 3)
+        return [(topics_height, 0, height - topics_height, index_width),
+                (0, index_width, main_height, main_width),
+                (main_height, index_width, related_height, main_width),
+                (0, 0, topics_height, index_width),
+                (height, 0, 1, width)]
+
+    def resize(self):
+        """Lay the windows out again for the terminal's new size and draw
+        each one's contents again from what it was last showing; only a
+        taller index may need another page of notes to fill it."""
+        height, width = self.scr.getmaxyx()
+        if height < self.min_height or width < self.min_width:
+# Too small to draw anything into; wait for it to be made bigger again:
+            return
+        for win, place in zip(self.windows, self.layout(height, width)):
+            win.place(*place)
+        for win in self.windows:
+            win.redraw()
         
     def add_keyword(self, keyword):
         self.keywords.add(keyword)
@@ -298,61 +896,336 @@ class Interface(object):
         raise SystemExit
 
     def up(self):
-        if not self.note_index.notes:
+        if self.selected is self.topic_pane:
+            if self.topic_pane.up():
+                self.choose_topic()
             return
         self.note_index.up()
-        self.note_display.display_note(
-            self.note_index.notes[self.note_index.selected],
-            self.keywords
-            )
+        self.show_selected()
 
     def down(self):
-        if not self.note_index.notes:
+        if self.selected is self.topic_pane:
+            if self.topic_pane.down():
+                self.choose_topic()
             return
         self.note_index.down()
-        self.note_display.display_note(
-            self.note_index.notes[self.note_index.selected],
-            self.keywords
-            )
+        self.show_selected()
+
+    def switch_pane(self):
+        """Move between the index and the topic pane."""
+        if self.selected is self.topic_pane:
+            self.selected = self.note_index
+        else:
+            self.selected = self.topic_pane
+        self.topic_pane.focus(self.selected is self.topic_pane)
+
+    def source(self):
+        """The pager and title for the index: every note, or the notes under
+        the topic selected in the topic pane."""
+        topic = self.topic_pane.topic
+        if topic is None:
+            return self.pager, "Notes:"
+        pager = lambda **kwargs: self.pager(topic=topic, **kwargs)
+        return pager, "Topic: %s" % (topic,)
+
+    def choose_topic(self):
+        """List the notes under the topic selected in the topic pane, which
+        also ends any search."""
+        if self.pager is None:
+            return
+        self.searching = False
+        self.note_index.set_source(*self.source())
+        self.show_selected()
+
+    def show_topics(self, topics):
+        """Fill the topic pane with (topic, count) pairs; if the topic being
+        listed has no notes left, the index goes back to every note."""
+        topic = self.topic_pane.topic
+        self.topic_pane.show_topics(topics)
+        if self.topic_pane.topic != topic:
+            self.choose_topic()
+
+    def search(self):
+        """Prompt for a query and let the callback fill the index with the
+        results (see show_results); an empty query goes back to the full list
+        of notes."""
+        query = self.note_index.prompt("/")
+        if query and self.callback is not None:
+# The results may take a moment; put the listing back under the prompt:
+            self.note_index.repopulate()
+            self.callback(self, search=query)
+            return
+        elif self.searching and self.pager is not None:
+            self.note_index.set_source(*self.source())
+            self.searching = False
+        else:
+            self.note_index.repopulate()
+        self.show_selected()
+
+    def show_results(self, query, results):
+        """Replace the index with search results, given as (note, snippet)
+        pairs, until the search is cleared."""
+        self.searching = True
+        self.note_index.set_notes([x[0] for x in results],
+            "Search: %s (%d)" % (query, len(results)),
+            dict((x[0].id, x[1]) for x in results))
+        self.show_selected()
+
+    def show_selected(self):
+        """Display the selected note and ask the callback for its related
+        notes (see show_related)."""
+        index = self.note_index
+        if index.selected == -1:
+            self.show_note(None, None)
+            return
+        note = index.notes[index.selected]
+        if self.loader is None:
+            self.show_note(note, note.id)
+            return
+        nearby = [x.id for x in index.notes[max(index.selected - self.nearby,
+                                    0):index.selected + self.nearby + 1]]
+        if self.worker is None:
+            self.show_note(self.loader(note.id, nearby=nearby), note.id)
+        else:
+            self.worker.submit(self.loader, (note.id,), {'nearby': nearby},
+                done=lambda loaded, note_id=note.id: self.show_note(loaded,
+                                                                    note_id),
+                key="load")
+
+    def show_note(self, note, note_id):
+        """Display the note loaded for the row with note_id (None if there's
+        no such note), unless the selection has moved on since, and ask the
+        callback for its related notes."""
+        index = self.note_index
+        selected = None
+        if index.selected != -1:
+            selected = index.notes[index.selected].id
+        if selected != note_id:
+            return
+        if note is not None:
+            self.note_display.display_note(note, self.keywords)
+            if self.callback is not None:
+                self.callback(self, related=note)
+        else:
+            self.note_display.blank()
+            self.show_related([])
+
+    def show_related(self, notes):
+        self.related.show_notes(notes)
+
+    def selected_note(self):
+        index = self.note_index
+        if index.selected == -1:
+            return None
+        return index.notes[index.selected]
 
     def delete(self):
+        """Delete the marked notes, or the selected one if none are marked,
+        as one batch that undo can bring back."""
+        index = self.note_index
+# Take the notes out of the index before the callback runs, otherwise the
+# change feed would report the deletion and remove them a second time:
+        if index.marked:
+            ids = sorted(index.marked)
+            index.remove(ids)
+        elif index.selected != -1:
+            ids = [index.notes[index.selected].id]
+            index.delete(index.selected)
+        else:
+            return
+        for note_id in ids:
+            self.note_display.forget(note_id)
+        self.deleted.append(ids)
+        del self.deleted[:-self.undo_limit]
         if self.callback is not None:
-            self.callback(self,
-                    delete=self.note_index.notes[self.note_index.selected])
-        self.note_index.delete(self.note_index.selected)
+            self.callback(self, delete=ids)
+        self.show_selected()
 
-    def insert_note(self, note, x=0):
-        self.note_index.insert(note, x)
+    def undo(self):
+        """Bring back the notes deleted last; they're listed again once the
+        change feed reports them restored."""
+        if self.deleted and self.callback is not None:
+            self.callback(self, restore=self.deleted.pop())
+
+    def mark(self):
+        """Mark or unmark the selected note, which is where the next
+        mark_range starts from."""
+        note = self.selected_note()
+        if note is None:
+            return
+        self.anchor = note.id
+        self.note_index.mark([note.id], note.id not in self.note_index.marked)
+
+    def mark_range(self):
+        """Mark every note from the one last marked or unmarked to the
+        selected one. The notes in between that are held are marked straight
+        away and the callback is asked for the rest (see mark_ids)."""
+        note = self.selected_note()
+        if note is None or self.anchor is None:
+            return
+        first, last = sorted((self.anchor, note.id))
+        self.note_index.mark([x.id for x in self.note_index.notes
+                              if first <= x.id <= last])
+        if self.callback is not None:
+            self.callback(self, mark_range=(first, last))
+
+    def mark_topic(self):
+        """Prompt for a topic and let the callback mark every note under it
+        (see mark_ids)."""
+        topic = self.note_index.prompt("Mark topic: ")
+        self.note_index.repopulate()
+        if topic and self.callback is not None:
+            self.callback(self, mark_topic=topic)
+
+    def mark_ids(self, ids):
+        self.note_index.mark(ids)
+
+    def clear_marks(self):
+        self.note_index.mark(list(self.note_index.marked), False)
+
+    def reload(self):
+        """List the notes afresh from the pager, for when what changed
+        elsewhere can't be told note by note; search results are left alone,
+        as the listing is reloaded when the search ends anyway."""
+        if self.searching or self.pager is None:
+            return
+        self.note_display.forget()
+        self.note_index.set_source(*self.source())
+        self.show_selected()
+
+    def remove_note(self, note_id):
+        """Remove a note that was deleted elsewhere, by id; notes that
+        aren't listed (e.g. because they were deleted from this interface)
+        are ignored."""
+        self.note_display.forget(note_id)
+        self.note_index.marked.discard(note_id)
+        for i, note in enumerate(self.note_index.notes):
+            if note.id == note_id:
+                self.note_index.delete(i)
+                return
 
-    def add_note(self, note):
-        self.note_index.append(note)
+    def insert_note(self, note):
+        """List a note that was added (or restored) elsewhere in its place
+        by id, newest first; it's left for the pager to find if it belongs
+        past either end of the notes held."""
+# New notes turn up when the search is cleared and the listing reloaded; a
+# NoteRow doesn't say what topics the note is under, so under a topic they
+# turn up when it's chosen again:
+        if self.searching or self.topic_pane.topic is not None:
+            return
+        notes = self.note_index.notes
+        x = 0
+        while x < len(notes) and notes[x].id > note.id:
+            x += 1
+        if x < len(notes) and notes[x].id == note.id:
+            return
+        if x == len(notes) and not self.note_index.at_end:
+            return
+        self.note_index.insert(note, x)
 
     @property
     def index_count(self):
         return self.note_index.get_note_count()
 
     def update(self):
-        for win in (self.note_index, self.note_display):
+        """Redraw every window."""
+        for win in self.windows:
             win.update()
+        self.flush()
+
+    def flush(self):
+        """Send everything the windows have staged since the last flush to
+        the terminal in one go. The event loop does this once each time
+        round, however many keys and results it handled."""
+        if not any(x.staged for x in self.windows):
+            return
         curses.doupdate()
+        for win in self.windows:
+            win.staged = False
 
     def hard_update(self):
-        for win in (self.note_index, self.note_display):
+        for win in self.windows:
             win.hard_update()
         self.update()
 
     def get_key(self):
+        """Return the next key, or None if there isn't one within the
+        timeout."""
         try:
-            key = self.note_display.window.getkey()
+            return self.note_display.window.getkey()
         except curses.error, e:
-            self.hard_update()
-            key = None
-        return key
+            return None
+
+    def handle_key(self, key):
+        if key is not None:
+            self.message = None
+        if key in self.keys_dispatch:
+            self.keys_dispatch[key]()
+
+    def report(self, message):
+        """Show a message on the status line until the next key, e.g. that
+        some database work failed."""
+        self.message = message
+        self.show_status()
+
+    def show_status(self):
+        if self.message is not None:
+            self.status_line.show(self.message)
+        elif self.status is not None:
+            self.status_line.show(self.status())
+        else:
+            self.status_line.show("")
+
+    def end_frame(self):
+        """Let the callback catch up with the database after a key or a
+        change."""
+        if self.callback is not None:
+            self.callback(self)
+        self.show_status()
+
+    def wait(self):
+        """Sleep until there's a key to read or the watcher sees a change,
+        and return whether the database changed."""
+        fds = [0]
+        if self.watcher.fileno() is not None:
+            fds.append(self.watcher.fileno())
+        if self.worker is not None:
+            fds.append(self.worker.fileno())
+        try:
+            select.select(fds, [], [], self.watcher.timeout)
+        except select.error, e:
+# A signal (e.g. the terminal being resized) cuts the wait short:
+            if e.args[0] != errno.EINTR:
+                raise
+        return self.watcher.changed()
 
     def handle_events(self):
+        if self.watcher is None:
+            while True:
+                self.flush()
+                key = self.get_key()
+                if key is None:
+                    self.hard_update()
+                self.handle_key(key)
+                if self.worker is not None:
+                    self.worker.dispatch()
+                self.end_frame()
+
         while True:
+            self.flush()
+            changed = self.wait()
+# Read every key that's come in, which may be more than select() saw as curses
+# can already have some buffered:
+            pressed = False
             key = self.get_key()
-            if key in self.keys_dispatch:
-                self.keys_dispatch[key]()
-            if self.callback is not None:
-                self.callback(self)
+            while key is not None:
+                pressed = True
+                self.handle_key(key)
+                key = self.get_key()
+# Results from the worker are drawn as they come in, but don't call for
+# another trip to the database:
+            results = self.worker is not None and self.worker.dispatch()
+            if pressed or changed:
+                self.end_frame()
+            elif results:
+                self.show_status()
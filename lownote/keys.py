@@ -3,4 +3,11 @@ keys = {
     'up': 'k',
     'down': 'j',
     'delete': 'd',
+    'undo': 'u',
+    'mark': 'm',
+    'mark_range': 'M',
+    'mark_topic': 'T',
+    'clear_marks': 'C',
+    'search': '/',
+    'switch_pane': '\t',
 }
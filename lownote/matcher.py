@@ -0,0 +1,226 @@
+"""Find every known keyword in a body of text in a single pass, using an
+Aho-Corasick automaton over the keyword vocabulary. Keywords can contain any
+characters (including spaces, so multi-word keywords work) and matching is
+case-insensitive."""
+from lownote.model import shared
+
+def _is_word(char):
+    return char.isalnum() or char == "_"
+
+class KeywordMatcher(object):
+    """The vocabulary is kept in a trie of dicts; each node is a number
+    indexing the parallel lists below rather than an object, which keeps a
+    large vocabulary cheap to hold. The keywords given up front (or added
+    before anything is matched) are linked up in one go by build(); after
+    that every keyword added updates the automaton in place (see _link), so
+    adding a note that brings in a new keyword doesn't cost a pass over the
+    whole vocabulary."""
+
+    def __init__(self, keywords=()):
+        self.goto = [{}]
+        self.fail = [0]
+        self.terminal = [None]
+        self.output = [()]
+        # The nodes whose failure link points to each node, i.e. the failure
+        # links the other way round; the root's are left out as that's most
+        # nodes:
+        self.fail_children = {}
+        self.keywords = set()
+        self.stale = True
+        # Goes up whenever a keyword is added, so anything derived from the
+        # vocabulary can tell when it's out of date:
+        self.version = 0
+        for keyword in keywords:
+            self.add(keyword)
+
+    def __contains__(self, keyword):
+        return keyword.lower() in self.keywords
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def add(self, keyword):
+        """Add a keyword to the vocabulary; return False if it was already
+        known."""
+
+        keyword = keyword.lower()
+        if not keyword or keyword in self.keywords:
+            return False
+# Every matcher (e.g. the interface's and the Noter's) then shares the one
+# copy of each keyword:
+        keyword = shared(keyword)
+        self.keywords.add(keyword)
+        self.version += 1
+
+        node = 0
+        created = []
+        for char in keyword:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.terminal.append(None)
+                self.output.append(())
+                self.goto[node][char] = next_node
+                created.append((node, char, next_node))
+            node = next_node
+        self.terminal[node] = keyword
+        if not self.stale:
+            self._link(created, node)
+        return True
+
+    def _link(self, created, end):
+        """Bring the failure links and outputs up to date after add() has
+        put in the nodes in created, as (parent, char, node) shallowest
+        first, and made end a terminal. The new nodes get their links the
+        same way build() works them out; then each older node whose longest
+        suffix in the trie is now one of the new nodes is pointed at it, and
+        the outputs are worked out again below every node whose link or
+        terminal changed. That costs the length of the keyword plus the
+        nodes whose strings end in the new nodes' parents, which is small
+        except when the keyword starts with a character no keyword started
+        with before: the whole trie is then checked once."""
+
+        goto = self.goto
+        fail = self.fail
+        changed = set([end])
+        for parent, char, node in created:
+            changed.add(node)
+            if parent == 0:
+                self._set_fail(node, 0)
+# Every older node reached by char that had no suffix in the trie at all now
+# has this one:
+                for x in xrange(len(goto)):
+                    child = goto[x].get(char)
+                    if child is not None and child != node and \
+                            fail[child] == 0:
+                        self._set_fail(child, node)
+                        changed.add(child)
+                continue
+
+            state = fail[parent]
+            while state and char not in goto[state]:
+                state = fail[state]
+            self._set_fail(node, goto[state].get(char, 0))
+# The older nodes whose strings end in the parent's and that have a char
+# child: that child's longest suffix in the trie is now this node, unless a
+# node in between already had a char child, whose links go there or deeper.
+            stack = list(self.fail_children.get(parent, ()))
+            while stack:
+                x = stack.pop()
+                child = goto[x].get(char)
+                if child is None:
+                    stack.extend(self.fail_children.get(x, ()))
+                elif child != node:
+                    self._set_fail(child, node)
+                    changed.add(child)
+
+# Outputs are filled in down the failure links, from each changed node that
+# isn't itself below another one:
+        for node in changed:
+            state = fail[node]
+            while state and state not in changed:
+                state = fail[state]
+            if not state:
+                self._fill_output(node)
+
+    def _set_fail(self, node, link):
+        old = self.fail[node]
+        if old and node in self.fail_children.get(old, ()):
+            self.fail_children[old].remove(node)
+        self.fail[node] = link
+        if link:
+            self.fail_children.setdefault(link, []).append(node)
+
+    def _fill_output(self, node):
+        """Work out the output of node and of every node whose failure links
+        lead to it."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            own = self.terminal[node]
+            own = own is not None and (own,) or ()
+            self.output[node] = own + self.output[self.fail[node]]
+            stack.extend(self.fail_children.get(node, ()))
+
+    def build(self):
+        """Compute the failure links breadth first, merging the output of
+        each node with the output of the node its failure link points to so
+        that keywords ending inside longer keywords are found as well."""
+
+        self.output = [x is not None and (x,) or () for x in self.terminal]
+        self.fail_children = {}
+        queue = []
+        for child in self.goto[0].itervalues():
+            self.fail[child] = 0
+            queue.append(child)
+
+        for node in queue:
+            for char, child in self.goto[node].iteritems():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                fail = self.goto[state].get(char, 0)
+                self.fail[child] = fail
+                if fail:
+                    self.fail_children.setdefault(fail, []).append(child)
+                if self.output[fail]:
+                    self.output[child] = self.output[child] + self.output[fail]
+        self.stale = False
+
+    def spans(self, text):
+        """Yield a (start, end) slice for every occurrence of a known keyword
+        in the text as a whole word (or words), in order of where they end.
+        Occurrences can overlap when one keyword contains another."""
+
+        if self.stale:
+            self.build()
+
+        text = text.lower()
+        length = len(text)
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword in output[state]:
+# Only whole words count: a keyword starting or ending with a word character
+# mustn't run on into a neighbouring word character.
+                start = i - len(keyword) + 1
+                if _is_word(keyword[0]) and start > 0 and \
+                        _is_word(text[start - 1]):
+                    continue
+                if _is_word(keyword[-1]) and i + 1 < length and \
+                        _is_word(text[i + 1]):
+                    continue
+                yield start, i + 1
+
+    def find(self, text):
+        """Yield each known keyword that appears in the text as a whole word
+        (or words), once, in the order they are first found."""
+
+        lowered = text.lower()
+        found = set()
+        for start, end in self.spans(lowered):
+            keyword = lowered[start:end]
+            if keyword not in found:
+                found.add(keyword)
+                yield keyword
+
+    def highlight(self, text):
+        """Return the (start, end) slices of the text to highlight: the
+        longest keyword at each point, earliest first, without overlaps."""
+
+        matches = sorted(self.spans(text), key=lambda x: (x[0], -x[1]))
+        slices = []
+        end = 0
+        for match in matches:
+            if match[0] >= end:
+                slices.append(match)
+                end = match[1]
+        return slices
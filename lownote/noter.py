@@ -1,11 +1,98 @@
 """The main legwork of the note-taking, this is where all the SQL stuff
 goes."""
 from sqlalchemy import (create_engine, Table, Column, Integer, String,
-                        DateTime, MetaData, ForeignKey)
-from sqlalchemy.orm import mapper, sessionmaker, relation, backref
-from sqlalchemy.exceptions import InvalidRequestError
-from lownote.model import Note, Keyword, Topic
+                        DateTime, MetaData, ForeignKey, Index, select, func,
+                        and_)
+from sqlalchemy.orm import mapper, sessionmaker, relation, backref, eagerload
+from sqlalchemy.exceptions import InvalidRequestError, DBAPIError
+from sqlalchemy.interfaces import PoolListener
+from lownote.model import (Note, NoteRow, NoteRecord, Keyword, Topic,
+                            parse_due_date, parse_date, shared)
+from lownote.matcher import KeywordMatcher
+from lownote.cache import LRUCache
+import datetime
+import heapq
+import multiprocessing
 import re
+import signal
+import sqlite3
+
+class StorageSettings(PoolListener):
+    """Applies the storage pragmas to every connection the engine opens;
+    most of them only last as long as the connection, so setting them once
+    on the database isn't enough."""
+
+    choices = {
+        'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal',
+                            'off'),
+        'synchronous': ('off', 'normal', 'full', 'extra', '0', '1', '2',
+                            '3'),
+    }
+
+    def __init__(self, settings):
+        self.pragmas = []
+        for name, value in sorted(settings.iteritems()):
+            if name in self.choices:
+# The rc file parser turns on and off into booleans:
+                if value is True or value is False:
+                    value = value and "on" or "off"
+                value = str(value).lower()
+                if value not in self.choices[name]:
+                    raise ValueError("%s must be one of: %s" %
+                                        (name, ", ".join(self.choices[name])))
+            else:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise ValueError("%s must be a number" % (name,))
+            self.pragmas.append("PRAGMA %s = %s" % (name, value))
+
+    def connect(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        for pragma in self.pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+# The keyword matcher and database connection of each reindex_keywords worker
+# process:
+_reindex_matcher = None
+_reindex_vocabulary = None
+_reindex_connection = None
+
+def _reindex_init(db_path, vocabulary, worker=True):
+    """Set up a reindex_keywords worker with its own connection (plain
+    sqlite3, as SQLAlchemy's connections mustn't cross a fork) and matcher
+    for the vocabulary, a dict of keyword -> id."""
+    global _reindex_matcher, _reindex_vocabulary, _reindex_connection
+    if worker:
+# Ctrl-C is for the parent to deal with:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _reindex_vocabulary = vocabulary
+    _reindex_matcher = KeywordMatcher(vocabulary)
+    _reindex_connection = sqlite3.connect(db_path, timeout=30)
+
+def _reindex_range(id_range):
+    """Find the keywords of every note with an id in the range, returning
+    the range and the (note, keyword) links for it."""
+    first, last = id_range
+    links = []
+    for note_id, body in _reindex_connection.execute("SELECT id, body FROM "
+            "notes WHERE id BETWEEN ? AND ?", (first, last)):
+        for keyword in _reindex_matcher.find(body or ""):
+            links.append({'note': note_id,
+                          'keyword': _reindex_vocabulary[keyword]})
+    return first, last, links
+
+def _reindex_worker(db_path, vocabulary, tasks, results):
+    """Run a reindex_keywords worker process: take ranges from the tasks
+    queue until it gets None, putting the links found (or whatever went
+    wrong) on the results queue."""
+    try:
+        _reindex_init(db_path, vocabulary)
+        for id_range in iter(tasks.get, None):
+            results.put(_reindex_range(id_range))
+    except Exception, e:
+        results.put(e)
 
 class Noter(object):
     """There needs to be an abstraction between the actual database and the
@@ -14,113 +101,1198 @@ class Noter(object):
     work and provide a completely abstracted interface for the rest of 
     the program to work with."""
 
-    def __init__(self, db_path):
+    # Keywords or topics shared by more notes than this are ignored when
+    # looking for related notes:
+    common_limit = 1000
+    # Listings only carry the start of each body:
+    preview_length = 100
+    # The number of fully loaded notes to keep around:
+    cache_size = 200
+    # Stored in the database (PRAGMA user_version) once its tables, indexes
+    # and triggers are all in place; bump it whenever any of them change so
+    # that existing databases get brought up to date on their next open:
+    schema_version = 5
+    # Notes checked for a new keyword per transaction by backfill_keywords:
+    backfill_batch = 200
+    # How long deleted notes are kept, so they can still be restored, before
+    # purge_deleted removes them, and how many it removes per transaction:
+    purge_after = datetime.timedelta(days=7)
+    purge_batch = 500
+    # How many of the newest note log entries purge_deleted keeps; a reader
+    # that has fallen further behind than this reloads (see get_changes):
+    log_keep = 10000
+    # Storage pragmas for every connection, which the storage argument (e.g.
+    # from the rc file) can override. WAL lets the interface keep reading
+    # while notes are added from the command line, and the busy timeout
+    # makes a writer wait for another writer rather than fail with "database
+    # is locked"; the cache sizes are in KiB when negative:
+    storage_defaults = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16000,
+    }
+
+    def __init__(self, db_path, storage=None):
         """Initialise the database if it doesn't already exist; the notes
         table needs to have a many-to-many relationship with both the keywords
-        and the topics tables."""
+        and the topics tables. storage maps any of the storage_defaults to
+        the value to use instead."""
 
         self.db_path = db_path
-        self.engine = create_engine('sqlite:///' + db_path, echo=False)
+        settings = dict(self.storage_defaults)
+        settings.update(storage or {})
+        self.engine = create_engine('sqlite:///' + db_path, echo=False,
+                                    listeners=[StorageSettings(settings)])
 
         self.metadata = MetaData()
 
-        notes_table = Table('notes', self.metadata,
+        self.notes_table = notes_table = Table('notes', self.metadata,
             Column('id', Integer, primary_key=True, index=True),
             Column('body', String(4000)),
             Column('date', DateTime()),
             Column('due_date', DateTime()),
+# When the note was deleted, or NULL for every note that's still there;
+# deleted notes stay in the table (so they can be restored) until
+# purge_deleted removes them for good.
+            Column('deleted', DateTime()),
        )
 
-        keywords_table = Table('keywords', self.metadata,
+# Keywords and topics are vocabularies with one row per distinct word, linked
+# to the notes through association tables. The primary key of each link table
+# covers lookups by note and the extra index covers lookups the other way
+# round (all the notes for a keyword or topic).
+        self.keywords_table = keywords_table = Table('keywords',
+            self.metadata,
             Column('id', Integer, primary_key=True),
-            Column('keyword', String(50), nullable=False, index=True),
-            Column('note', Integer, ForeignKey('notes.id')),
+            Column('keyword', String(50), nullable=False, index=True,
+                    unique=True),
        )
             
-        topics_table = Table('topics', self.metadata,
+        self.topics_table = topics_table = Table('topics', self.metadata,
             Column('id', Integer, primary_key=True),
-            Column('topic', String(100), nullable=False, index=True),
-            Column('note', Integer, ForeignKey('notes.id')),
+            Column('topic', String(100), nullable=False, index=True,
+                    unique=True),
+       )
+
+        self.note_keywords_table = note_keywords_table = Table(
+            'note_keywords', self.metadata,
+            Column('note', Integer, ForeignKey('notes.id'), primary_key=True),
+            Column('keyword', Integer, ForeignKey('keywords.id'),
+                    primary_key=True),
+       )
+        Index('ix_note_keywords_keyword', note_keywords_table.c.keyword,
+                note_keywords_table.c.note)
+
+        self.note_topics_table = note_topics_table = Table('note_topics',
+            self.metadata,
+            Column('note', Integer, ForeignKey('notes.id'), primary_key=True),
+            Column('topic', Integer, ForeignKey('topics.id'),
+                    primary_key=True),
+       )
+        Index('ix_note_topics_topic', note_topics_table.c.topic,
+                note_topics_table.c.note)
+
+# The number of notes (deleted ones aside) under each topic, kept up to date
+# by triggers as notes are linked to topics, deleted and restored, so listing
+# the topics with their counts never has to count anything.
+        self.topic_counts_table = Table('topic_counts', self.metadata,
+            Column('topic', Integer, ForeignKey('topics.id'),
+                    primary_key=True),
+            Column('notes', Integer, nullable=False, default=0),
+       )
+
+# The note log is the change feed: triggers on the notes table append a row
+# for every insert, delete and restore, so any process can ask "what happened
+# since revision N" without rereading the notes table.
+        log_table = Table('note_log', self.metadata,
+            Column('rev', Integer, primary_key=True),
+            Column('note', Integer, nullable=False),
+            Column('action', String(10), nullable=False),
+       )
+
+# Keywords seen for the first time after there were already notes, which older
+# notes may mention without having been linked to them; position is the id
+# the backfill has worked its way back to (only notes below it are left to
+# check) and linked is how many notes it has linked so far.
+        self.backfill_table = Table('keyword_backfill', self.metadata,
+            Column('keyword', Integer, ForeignKey('keywords.id'),
+                    primary_key=True),
+            Column('position', Integer, nullable=False),
+            Column('linked', Integer, nullable=False, default=0),
+       )
+
+# The checkpoint of a reindex_keywords run: every note with an id below
+# position is done, up to last, the newest note when the run started, and
+# links to keywords with ids above keyword (i.e. newer than the vocabulary
+# the run works from) are left alone. There's only ever the one row, while a
+# run is going or after it was interrupted.
+        self.reindex_table = Table('reindex', self.metadata,
+            Column('position', Integer, nullable=False),
+            Column('last', Integer, nullable=False),
+            Column('keyword', Integer, nullable=False),
        )
 
         mapper(Note, notes_table, properties={
-            'topics': relation(Topic),
-            'keywords': relation(Keyword),
+            'topics': relation(Topic, secondary=note_topics_table),
+            'keywords': relation(Keyword, secondary=note_keywords_table),
             }
        )
         mapper(Keyword, keywords_table)
         mapper(Topic, topics_table)
 
-        self.metadata.create_all(self.engine) 
+        if self.engine.execute("PRAGMA user_version").scalar() < \
+                self.schema_version:
+            self._create_schema()
+# Whether there's a full-text index is only looked up when it's first needed:
+        self.fts = None
+        self.matcher = None
+        self.cache = LRUCache(self.cache_size)
         
         Session = sessionmaker(bind=self.engine, autoflush=True,
                                   transactional=True)
 
+# Every operation that loads or saves notes is a unit of work that ends by
+# emptying the session (see _end_unit), so however long the Noter lives the
+# session only ever holds what the current operation is working on.
         self.session = Session()
 
+        self.last_rev = self.session.execute(
+            "SELECT MAX(rev) FROM note_log").scalar() or 0
+        self.data_version = self._get_data_version()
+        self.dirty = False
+        self.seen_version = self.data_version
+
+    def _create_schema(self):
+        """Create whatever part of the schema is missing (all of it for a new
+        database), migrate anything in an older layout and record the schema
+        version. This reflects every table, so it's only done when the stored
+        version is behind; opening an up to date database skips it."""
+
+        legacy = self._retire_legacy_tables()
+        self.metadata.create_all(self.engine)
+        if legacy:
+            self._migrate_legacy_tables()
+        columns = [x[1] for x in self.engine.execute(
+            "PRAGMA table_info(notes)")]
+        if 'deleted' not in columns:
+            self.engine.execute("ALTER TABLE notes ADD COLUMN deleted "
+                                "TIMESTAMP")
+        self.engine.execute("CREATE INDEX IF NOT EXISTS ix_notes_deleted "
+            "ON notes (deleted) WHERE deleted IS NOT NULL")
+
+# Deleting a note sets its deleted date, which the log records as a delete
+# (and clearing it again as a restore); purging it later removes a row that
+# was already logged as deleted, so only removing a note that wasn't deleted
+# yet is logged.
+        self.engine.execute("DROP TRIGGER IF EXISTS note_log_delete")
+        self.engine.execute("CREATE TRIGGER note_log_delete AFTER DELETE ON "
+            "notes WHEN old.deleted IS NULL BEGIN INSERT INTO note_log "
+            "(note, action) VALUES (old.id, 'delete'); END")
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS note_log_insert "
+            "AFTER INSERT ON notes BEGIN INSERT INTO note_log (note, action) "
+            "VALUES (new.id, 'insert'); END")
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS note_log_deleted "
+            "AFTER UPDATE OF deleted ON notes "
+            "WHEN (old.deleted IS NULL) != (new.deleted IS NULL) "
+            "BEGIN INSERT INTO note_log (note, action) VALUES (new.id, "
+            "CASE WHEN new.deleted IS NULL THEN 'restore' ELSE 'delete' "
+            "END); END")
+        self._create_topic_counts()
+        self._create_search_index()
+        self.engine.execute("PRAGMA user_version = %d" %
+                            (self.schema_version,))
+
+    def _retire_legacy_tables(self):
+        """Older databases stored one keywords/topics row per word per note,
+        with the note id in the row. Move those tables out of the way (along
+        with their indexes, whose names the new tables reuse) so the
+        normalised tables can be created, and return whether there is
+        anything to migrate. A migration that was interrupted is picked up
+        where it left off."""
+
+        for table in ("keywords", "topics"):
+            columns = [x[1] for x in self.engine.execute(
+                "PRAGMA table_info(%s)" % (table,))]
+            if "note" in columns:
+                self.engine.execute("DROP INDEX IF EXISTS ix_%s_%s" %
+                                    (table, table[:-1]))
+                self.engine.execute("ALTER TABLE %s RENAME TO legacy_%s" %
+                                    (table, table))
+        return bool(self.engine.execute("SELECT 1 FROM sqlite_master WHERE "
+            "type = 'table' AND name IN ('legacy_keywords', 'legacy_topics')"
+            ).scalar())
+
+    def _migrate_legacy_tables(self):
+        """Fill the vocabulary and link tables from the retired per-note
+        tables in one transaction, then drop the retired tables. Words are
+        folded to lower case, so differently cased duplicates collapse into
+        one vocabulary entry."""
+
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            for table, column in (("keywords", "keyword"),
+                                  ("topics", "topic")):
+                if not conn.execute("SELECT 1 FROM sqlite_master WHERE "
+                        "type = 'table' AND name = 'legacy_%s'" %
+                        (table,)).scalar():
+                    continue
+                conn.execute("INSERT OR IGNORE INTO %(t)s (%(c)s) "
+                    "SELECT DISTINCT lower(%(c)s) FROM legacy_%(t)s"
+                    % {'t': table, 'c': column})
+                conn.execute("INSERT OR IGNORE INTO note_%(t)s (note, %(c)s) "
+                    "SELECT legacy.note, vocab.id FROM legacy_%(t)s legacy "
+                    "JOIN %(t)s vocab ON vocab.%(c)s = lower(legacy.%(c)s) "
+                    "JOIN notes ON notes.id = legacy.note"
+                    % {'t': table, 'c': column})
+            trans.commit()
+        except:
+            trans.rollback()
+            conn.close()
+            raise
+        conn.execute("DROP TABLE IF EXISTS legacy_keywords")
+        conn.execute("DROP TABLE IF EXISTS legacy_topics")
+        conn.close()
+
+    def _create_topic_counts(self):
+        """Create the triggers that keep topic_counts up to date and count
+        the notes under each topic afresh, for a database that didn't have
+        the table or whose links were written before the triggers were."""
+
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS topic_counts_insert "
+            "AFTER INSERT ON note_topics "
+            "WHEN (SELECT deleted FROM notes WHERE id = new.note) IS NULL "
+            "BEGIN INSERT OR IGNORE INTO topic_counts (topic, notes) "
+            "VALUES (new.topic, 0); UPDATE topic_counts SET notes = notes + 1 "
+            "WHERE topic = new.topic; END")
+# Purging a deleted note removes its links, but it was already taken off the
+# counts when it was deleted:
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS topic_counts_delete "
+            "AFTER DELETE ON note_topics "
+            "WHEN (SELECT deleted FROM notes WHERE id = old.note) IS NULL "
+            "BEGIN UPDATE topic_counts SET notes = notes - 1 "
+            "WHERE topic = old.topic; END")
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS "
+            "topic_counts_deleted AFTER UPDATE OF deleted ON notes "
+            "WHEN (old.deleted IS NULL) != (new.deleted IS NULL) "
+            "BEGIN UPDATE topic_counts SET notes = notes + "
+            "CASE WHEN new.deleted IS NULL THEN 1 ELSE -1 END "
+            "WHERE topic IN (SELECT topic FROM note_topics "
+            "WHERE note = new.id); END")
+
+        self.engine.execute("DELETE FROM topic_counts")
+        self.engine.execute("INSERT INTO topic_counts (topic, notes) "
+            "SELECT note_topics.topic, COUNT(*) FROM note_topics "
+            "JOIN notes ON notes.id = note_topics.note "
+            "WHERE notes.deleted IS NULL GROUP BY note_topics.topic")
+
+    def _create_search_index(self):
+        """Create the full-text index over the note bodies if it doesn't
+        exist yet and return whether full-text search is available. The index
+        is an external content FTS5 table (it stores no copy of the bodies)
+        and triggers keep it in step with the notes table, so add_note and
+        delete_note, or anything else writing to the notes, never leave it
+        stale. An existing database gets its index built on first use."""
+
+        exists = self.engine.execute("SELECT 1 FROM sqlite_master WHERE "
+            "type = 'table' AND name = 'notes_fts'").scalar()
+        if not exists:
+            try:
+                self.engine.execute("CREATE VIRTUAL TABLE notes_fts USING "
+                    "fts5(body, content='notes', content_rowid='id')")
+            except DBAPIError:
+# SQLite built without FTS5; search() falls back to scanning the notes.
+                return False
+            self.engine.execute(
+                "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS notes_fts_insert "
+            "AFTER INSERT ON notes BEGIN "
+            "INSERT INTO notes_fts (rowid, body) VALUES (new.id, new.body); "
+            "END")
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS notes_fts_delete "
+            "AFTER DELETE ON notes BEGIN "
+            "INSERT INTO notes_fts (notes_fts, rowid, body) "
+            "VALUES ('delete', old.id, old.body); END")
+        self.engine.execute("CREATE TRIGGER IF NOT EXISTS notes_fts_update "
+            "AFTER UPDATE OF body ON notes BEGIN "
+            "INSERT INTO notes_fts (notes_fts, rowid, body) "
+            "VALUES ('delete', old.id, old.body); "
+            "INSERT INTO notes_fts (rowid, body) VALUES (new.id, new.body); "
+            "END")
+        return True
+
+    def refresh(self):
+        """For a Noter that stays open a long time (e.g. lownote --serve):
+        if another connection has committed since the last call, drop the
+        keyword matcher, cached notes and session state so the next request
+        sees the other process's notes and keywords. Costs one pragma when
+        nothing has changed."""
+
+        version = self._get_data_version()
+        if version is not None and version == self.seen_version:
+            return
+        self.seen_version = version
+        self.matcher = None
+        self.cache.clear()
+        self._end_unit()
+
+    def _end_unit(self):
+        """End the current unit of work: end the session's transaction and
+        detach everything it loaded, leaving it empty for the next one.
+        Nothing loaded through the session is handed out (see get_note), so
+        nothing outside the Noter keeps any of it alive either."""
+
+        self.session.close()
+
+    def rollback(self):
+        """Abandon whatever the current unit of work was doing, e.g. after
+        an error part way through adding a note."""
+
+        self.session.rollback()
+        self._end_unit()
+
     def get_stored_keywords(self):
         """Retrieve and yield all keywords from database."""
 
-        for keyword in self.session.query(Keyword):
-            yield keyword.keyword
+        for keyword in self.session.execute("SELECT keyword FROM keywords"):
+            yield keyword[0]
+
+    def _get_word(self, cls, attr, word):
+        """Return the vocabulary entry (a Keyword or Topic) for the word,
+        creating it if the word is new."""
+
+        entry = self.session.query(cls).filter_by(**{attr: word}).first()
+        if entry is None:
+            entry = cls(word)
+            self.session.save(entry)
+        return entry
+
+    def get_matcher(self):
+        """Return the keyword matcher for the distinct keyword vocabulary,
+        loading it from the database the first time it's needed; after that
+        it's kept up to date by get_keywords as new keywords appear."""
+
+        if self.matcher is None:
+            self.matcher = KeywordMatcher(x[0] for x in self.session.execute(
+                "SELECT keyword FROM keywords"))
+        return self.matcher
 
     def get_keywords(self, body):
         """Parse the body of the note and yield keywords as they are found.
         Note that this method also needs to check if any keywords are found in
-        the note that are not explicitly %%referenced%% by checking the
-        keywords table and comparing each word in the body of the note to
-        it."""
+        the note that are not explicitly %%referenced%%, which the keyword
+        matcher does in one pass over the body for the whole vocabulary
+        (multi-word keywords included). Each keyword is yielded once."""
 
+        matcher = self.get_matcher()
         keywords = set([])
         for keyword in re.finditer("%%(.+?)%%", body):
             keyword = keyword.group(1).lower()
+            if keyword in keywords:
+                continue
             keywords.add(keyword)
-            yield keyword.lower()
+            matcher.add(keyword)
+            yield keyword
         
-        db_keywords = set(x.keyword for x in self.session.query(Keyword))
-        for word in re.split(r'\b(.+?)\b', body):
-            if not word:
-                continue
-            word = word.lower()
-            if word not in keywords and word in db_keywords:
-                yield word
-
+        for keyword in matcher.find(body):
+            if keyword not in keywords:
+                yield keyword
 
     def add_note(self, body, due_date=None, topics=[]):
         """The body of the note is always required, otherwise there's no note
         to add. "topics" and "keywords" are not required but they must always
         be a list, even if it contains one element (so as not to need any type
         checking). This method needs to process the note (i.e. parse for
-        keywords) and add it to the database."""
+        keywords) and add it to the database, and returns the new note's
+        id."""
         
         note = Note(body, due_date)
         self.session.save(note)
 
-        for topic in topics:
-            note.topics.append(Topic(topic))
+        for topic in set(x.lower() for x in topics):
+            note.topics.append(self._get_word(Topic, 'topic', topic))
 
+        new_keywords = []
         for keyword in self.get_keywords(body):
-            note.keywords.append(Keyword(keyword))
+            entry = self._get_word(Keyword, 'keyword', keyword)
+# Checked straight away, as the next query flushes it:
+            if entry in self.session.new:
+                new_keywords.append(entry)
+            note.keywords.append(entry)
 
         note.body = note.body.replace('%%', '')
+        if new_keywords:
+            self.session.flush()
+            self.session.execute(self.backfill_table.insert(),
+                [{'keyword': x.id, 'position': note.id, 'linked': 0}
+                 for x in new_keywords])
+        self.session.commit()
+        self._end_unit()
+        self.dirty = True
+        return note.id
+
+    def import_notes(self, records, topics=(), batch_size=1000,
+                        progress=None):
+        """Add notes in bulk from an iterable of records (see
+        lownote.transfer), e.g. when moving a whole notebook in from
+        elsewhere. Keywords are found the same way add_note finds them, but
+        the notes and their links are written with one executemany per table
+        for every batch_size notes, each batch in its own transaction, and
+        records are only read as they're needed so the input can be of any
+        size. The topics given are added to every note, and progress, if
+        given, is called with the running total after each batch. Returns
+        the number of notes added."""
+
+        vocabularies = {
+            'keyword': dict(self.session.execute(
+                "SELECT keyword, id FROM keywords").fetchall()),
+            'topic': dict(self.session.execute(
+                "SELECT topic, id FROM topics").fetchall()),
+        }
+        topics = [x.lower() for x in topics]
+        count = 0
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_size:
+                count += self._import_batch(batch, topics, vocabularies)
+                batch = []
+                if progress is not None:
+                    progress(count)
+        if batch:
+            count += self._import_batch(batch, topics, vocabularies)
+            if progress is not None:
+                progress(count)
+        self.dirty = True
+        return count
+
+    def _import_batch(self, records, topics, vocabularies):
+        """Write one batch for import_notes in a single transaction. The
+        note ids are handed out here rather than by the database so the link
+        rows can be written in bulk too, which is why the transaction takes
+        the write lock up front."""
+
+        tables = {'keyword': self.keywords_table, 'topic': self.topics_table}
+        added = []
+        backfill = []
+        conn = self.session.connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            note_id = conn.execute("SELECT MAX(id) FROM notes").scalar() or 0
+
+            def word_id(kind, word):
+                if word not in vocabularies[kind]:
+                    vocabularies[kind][word] = conn.execute(
+                        tables[kind].insert(), {kind: word}
+                        ).last_inserted_ids()[0]
+                    added.append((kind, word))
+                    if kind == 'keyword':
+                        backfill.append({'keyword': vocabularies[kind][word],
+                                         'position': note_id, 'linked': 0})
+                return vocabularies[kind][word]
+
+            notes = []
+            note_keywords = []
+            note_topics = []
+            now = datetime.datetime.now()
+            for record in records:
+                note_id += 1
+                body = record['body']
+                date = record.get('date')
+                notes.append({
+                    'id': note_id,
+                    'body': body.replace('%%', ''),
+                    'date': date and parse_date(date) or now,
+                    'due_date': parse_due_date(record.get('due_date')),
+                })
+
+                keywords = set(self.get_keywords(body))
+                for keyword in record.get('keywords', ()):
+                    keyword = keyword.lower()
+                    self.get_matcher().add(keyword)
+                    keywords.add(keyword)
+                for keyword in keywords:
+                    note_keywords.append({'note': note_id,
+                        'keyword': word_id('keyword', keyword)})
+                for topic in set(topics + [x.lower() for x in
+                                            record.get('topics', ())]):
+                    note_topics.append({'note': note_id,
+                        'topic': word_id('topic', topic)})
+
+            conn.execute(self.notes_table.insert(), notes)
+            if note_keywords:
+                conn.execute(self.note_keywords_table.insert(), note_keywords)
+            if note_topics:
+                conn.execute(self.note_topics_table.insert(), note_topics)
+            if backfill:
+                conn.execute(self.backfill_table.insert(), backfill)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            for kind, word in added:
+                del vocabularies[kind][word]
+            raise
+        return len(records)
+
+    def pending_backfill(self):
+        """Return the number of keywords that older notes still have to be
+        checked for (see backfill_keywords)."""
+
+        return self.session.execute(
+            "SELECT COUNT(*) FROM keyword_backfill").scalar()
+
+    def backfill_keywords(self, batches=None, progress=None):
+        """Link older notes to the keywords that were first seen after them.
+        add_note and import_notes only look for the keywords known at the
+        time, so when a note brings in a new keyword the notes before it that
+        mention it are left unlinked; they're queued up in keyword_backfill
+        and found here, through the full-text index where there is one.
+
+        The work is done backfill_batch notes at a time, newest first, each
+        batch in its own short transaction that also records how far back
+        it got, so it can be stopped at any point (or interrupted) and
+        carries on from there next time, in this process or another. At
+        most batches batches are done (all of them if None) and progress,
+        if given, is called after each as progress(keyword, linked,
+        position), linked being the notes linked to the keyword so far and
+        position the id the backfill has got back to (0 once it's done).
+        Returns whether there's any backfill left."""
+
+        done = 0
+        while batches is None or done < batches:
+            if not self._backfill_batch(progress):
+                return False
+            done += 1
+        return bool(self.pending_backfill())
+
+    def _backfill_batch(self, progress):
+        """Check one batch of notes for the first keyword waiting to be
+        backfilled and return False if there wasn't one. The write lock is
+        taken up front so that two processes backfilling at once take turns
+        rather than check the same notes."""
+
+        conn = self.session.connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT backfill.keyword, keywords.keyword, "
+                "backfill.position, backfill.linked "
+                "FROM keyword_backfill backfill "
+                "JOIN keywords ON keywords.id = backfill.keyword "
+                "ORDER BY backfill.keyword LIMIT 1").fetchone()
+            if row is None:
+                self.session.rollback()
+                return False
+            keyword_id, keyword, position, linked = row
+
+            candidates = self._backfill_candidates(conn, keyword, position)
+            matcher = KeywordMatcher([keyword])
+            found = []
+            if candidates:
+                for note_id, body in conn.execute(select(
+                        [self.notes_table.c.id, self.notes_table.c.body],
+                        self.notes_table.c.id.in_(candidates))):
+                    for match in matcher.find(body or ""):
+                        found.append(note_id)
+                        break
+            if found:
+                linked += conn.execute("INSERT OR IGNORE INTO note_keywords "
+                    "(note, keyword) SELECT id, :keyword FROM notes "
+                    "WHERE id IN (%s)" % (",".join(str(x) for x in found),),
+                    {'keyword': keyword_id}).rowcount
+
+            if len(candidates) < self.backfill_batch:
+                position = 0
+                conn.execute("DELETE FROM keyword_backfill "
+                    "WHERE keyword = :keyword", {'keyword': keyword_id})
+            else:
+                position = candidates[-1]
+                conn.execute("UPDATE keyword_backfill SET position = "
+                    ":position, linked = :linked WHERE keyword = :keyword",
+                    {'position': position, 'linked': linked,
+                     'keyword': keyword_id})
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+# Cached notes have their keywords already; have them loaded again:
+        for note_id in found:
+            self.cache.discard(note_id)
+        if progress is not None:
+            progress(keyword, linked, position)
+        return True
+
+    def _backfill_candidates(self, conn, keyword, position):
+        """Return the ids, newest first, of up to backfill_batch notes older
+        than position that might mention the keyword. The full-text index
+        narrows them down to the notes with the keyword's words in that
+        order; without it (or for a keyword made up of punctuation alone)
+        the bodies are scanned with LIKE instead. Either way the candidates
+        still have to be checked with the matcher, e.g. "c++" only gives
+        the index "c" to go on."""
+
+        words = re.findall(r"\w+", keyword, re.UNICODE)
+        if self._has_fts() and words:
+            query = ("SELECT rowid FROM notes_fts WHERE notes_fts MATCH "
+                ":match AND rowid < :position ORDER BY rowid DESC "
+                "LIMIT :limit")
+            match = '"%s"' % (" ".join(words).replace('"', '""'),)
+        else:
+            query = ("SELECT id FROM notes WHERE id < :position AND body "
+                "LIKE :match ESCAPE '\\' ORDER BY id DESC LIMIT :limit")
+            match = "%%%s%%" % (re.sub(r"([%_\\])", r"\\\1", keyword),)
+        return [x[0] for x in conn.execute(query, {'match': match,
+                'position': position, 'limit': self.backfill_batch})]
+
+    def reindex_keywords(self, processes=None, chunk_size=1000,
+                            progress=None):
+        """Rebuild every note's keyword links from its body and the current
+        keyword vocabulary, e.g. after the rules for finding keywords have
+        changed or the link tables have got out of step with the notes. A
+        note ends up linked to exactly the keywords the matcher finds in it;
+        keywords an import gave a note without them being in its body are
+        dropped.
+
+        The notes are split into ranges of chunk_size ids, which worker
+        processes (one per CPU unless given) run the matcher over in
+        parallel; this process is the only writer and replaces the links of
+        each range in a transaction of its own as it comes back, so readers
+        (e.g. the interface) carry on throughout and only ever see a range
+        before or after. Each transaction also moves the checkpoint up to
+        the first range that isn't done yet, and an interrupted run carries
+        on from there the next time this is called (redoing any ranges past
+        it that were done, which does no harm). progress, if given, is
+        called after each range as progress(done, total), counting ids (some
+        of which may be gaps left by deleted notes) from where this call
+        started. Returns the number of ids covered."""
+
         self.session.commit()
+        row = self.session.execute(
+            "SELECT position, last, keyword FROM reindex").fetchone()
+        if row is None:
+            position = (self.session.execute(
+                "SELECT MIN(id) FROM notes").scalar() or 0)
+            last = self.session.execute(
+                "SELECT MAX(id) FROM notes").scalar() or 0
+            keyword = self.session.execute(
+                "SELECT MAX(id) FROM keywords").scalar() or 0
+            self.session.execute(self.reindex_table.insert(),
+                {'position': position, 'last': last, 'keyword': keyword})
+            self.session.commit()
+        else:
+            position, last, keyword = row
+
+        vocabulary = dict(self.session.execute("SELECT keyword, id FROM "
+            "keywords WHERE id <= :keyword", {'keyword': keyword}).fetchall())
+        ranges = [(x, min(x + chunk_size - 1, last))
+                  for x in xrange(position, last + 1, chunk_size)]
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        ends = dict(ranges)
+        done = set()
+        checkpoint = position
+        results = self._reindex_results(ranges, vocabulary, processes)
+        try:
+            for count, (first, end, links) in enumerate(results):
+                done.add(first)
+                while checkpoint in done:
+                    checkpoint = ends[checkpoint] + 1
+                self._reindex_write(first, end, links, keyword, checkpoint)
+                if progress is not None:
+                    progress(min((count + 1) * chunk_size,
+                        last + 1 - position), last + 1 - position)
+        finally:
+            results.close()
+
+        self.session.execute("DELETE FROM reindex")
+        self.session.commit()
+        self.cache.clear()
+        self._end_unit()
+        return max(last - position + 1, 0)
+
+    def _reindex_results(self, ranges, vocabulary, processes):
+        """Yield (first, last, links) for each of the ranges in the order
+        they're done in, from worker processes if there's more than one to
+        use; stopping early (e.g. closing the generator on an interrupt)
+        stops the workers. A queue is used to hand out the ranges rather
+        than a multiprocessing.Pool, as terminating a Pool whose results
+        aren't all in can hang."""
+
+        if processes < 2 or len(ranges) < 2:
+            _reindex_init(self.db_path, vocabulary, worker=False)
+            try:
+                for id_range in ranges:
+                    yield _reindex_range(id_range)
+            finally:
+                _reindex_connection.close()
+            return
+
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for id_range in ranges:
+            tasks.put(id_range)
+        workers = []
+        for i in xrange(min(processes, len(ranges))):
+            tasks.put(None)
+            worker = multiprocessing.Process(target=_reindex_worker,
+                args=(self.db_path, vocabulary, tasks, results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            for id_range in ranges:
+# With a timeout, as waiting without one can't be interrupted:
+                result = results.get(True, 3600)
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+# Ranges may be left in the queue, which mustn't hold up exiting:
+            tasks.cancel_join_thread()
+
+    def _reindex_write(self, first, last, links, keyword, checkpoint):
+        """Replace the links to the first keyword ids of the notes with ids
+        from first to last with the links given, and move the checkpoint up
+        to the given id, in one transaction."""
+
+        conn = self.session.connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM note_keywords WHERE note BETWEEN "
+                ":first AND :last AND keyword <= :keyword",
+                {'first': first, 'last': last, 'keyword': keyword})
+            if links:
+# Skipping any note that's been deleted since its range was read:
+                conn.execute("INSERT OR IGNORE INTO note_keywords "
+                    "(note, keyword) SELECT id, :keyword FROM notes "
+                    "WHERE id = :note", links)
+            conn.execute("UPDATE reindex SET position = :position",
+                {'position': checkpoint})
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+    def export_notes(self, topics=(), since=None, chunk_size=1000):
+        """Yield every note as a record (see lownote.transfer), oldest first,
+        optionally only the notes under any of the given topics and/or made
+        on or after the since date. Notes are read a chunk at a time by id,
+        and the keywords and topics for each chunk come from joined queries
+        over just that chunk's ids, so memory use stays the same however
+        large the notebook is (or however sparse the matching notes are) and
+        there's no query per note."""
+
+        notes = self.notes_table
+        where = [notes.c.deleted == None]
+        if since is not None:
+            where.append(notes.c.date >= since)
+        if topics:
+            note_topics = self.note_topics_table
+            where.append(notes.c.id.in_(select([note_topics.c.note],
+                and_(note_topics.c.topic == self.topics_table.c.id,
+                    self.topics_table.c.topic.in_(
+                        [x.lower() for x in topics])))))
+
+        last = 0
+        while True:
+            query = select([notes.c.id, notes.c.body, notes.c.date,
+                notes.c.due_date], and_(notes.c.id > last, *where)
+                ).order_by(notes.c.id.asc()).limit(chunk_size)
+            rows = self.session.execute(query).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            ids = [x[0] for x in rows]
+            words = {
+                'keywords': self._get_words(self.note_keywords_table,
+                                self.keywords_table, 'keyword', ids),
+                'topics': self._get_words(self.note_topics_table,
+                                self.topics_table, 'topic', ids),
+            }
+
+            for id, body, date, due_date in rows:
+                record = {'id': id, 'body': body,
+                            'date': date and date.isoformat()}
+                if due_date is not None:
+                    record['due_date'] = due_date.strftime("%Y%m%d")
+                for kind in words:
+                    record[kind] = words[kind].get(id, [])
+                yield record
+
+    def _get_words(self, link_table, table, column, ids):
+        """Return a dictionary of note id -> list of the keywords or topics
+        of the notes with the given ids, in one query per 500 ids."""
+
+        words = {}
+        for i in xrange(0, len(ids), 500):
+            query = select([link_table.c.note, table.c[column]],
+                and_(link_table.c.note.in_(ids[i:i+500]),
+                    link_table.c[column] == table.c.id))
+            for note_id, word in self.session.execute(query):
+                words.setdefault(note_id, []).append(word)
+        return words
 
     def delete_note(self, note):
-        """Take a note and remove it from the db by primary key (id)."""
-        self.session.delete(note)
+        """Take a note (or a NoteRow) and delete it by primary key (id); see
+        delete_notes."""
+        self.delete_notes([note.id])
+
+    def delete_notes(self, ids):
+        """Delete the notes with the given ids, however many, with one
+        UPDATE in one transaction. Deleting only marks the notes as deleted:
+        they're left out of every listing, search and export straight away
+        but stay in the database, links and all, so restore_notes can bring
+        them back until purge_deleted removes them for good."""
+
+        ids = sorted(set(ids))
+        if not ids:
+            return
+        for note_id in ids:
+            self.cache.discard(note_id)
+        self.session.execute("UPDATE notes SET deleted = :now "
+            "WHERE deleted IS NULL AND id IN (%s)" % self._id_list(ids),
+            {'now': datetime.datetime.now()})
+        self.session.commit()
+        self._end_unit()
+        self.dirty = True
+
+    def restore_notes(self, ids):
+        """Undo delete_notes for the notes with the given ids (those that
+        haven't been purged yet), again in one statement."""
+
+        ids = sorted(set(ids))
+        if not ids:
+            return
+        self.session.execute("UPDATE notes SET deleted = NULL "
+            "WHERE deleted IS NOT NULL AND id IN (%s)" % self._id_list(ids))
         self.session.commit()
+        self._end_unit()
+        self.dirty = True
+
+    def _id_list(self, ids):
+        """The ids written out for an IN (...) clause; they're ints, so
+        there's nothing to escape and no limit on how many there are, as
+        there would be on bound parameters."""
+        return ",".join(str(int(x)) for x in ids)
+
+    def pending_purge(self, before=None):
+        """Whether there are notes deleted before the given date (by default
+        purge_after ago) still to purge."""
+
+        if before is None:
+            before = datetime.datetime.now() - self.purge_after
+        return bool(self.session.execute("SELECT 1 FROM notes "
+            "WHERE deleted < :before LIMIT 1", {'before': before}).scalar())
+
+    def purge_deleted(self, batches=None, before=None):
+        """Remove the notes deleted before the given date (by default
+        purge_after ago) from the database for good, purge_batch notes at a
+        time: each batch is one transaction of one DELETE per table, the
+        links of the notes first and then the notes. batches limits how many
+        batches are done, e.g. one at a time in the background; returns
+        whether there are any more to purge. Every batch also trims the note
+        log to its newest log_keep entries."""
+
+        if before is None:
+            before = datetime.datetime.now() - self.purge_after
+        done = 0
+        while batches is None or done < batches:
+            conn = self.session.connection()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                ids = [x[0] for x in conn.execute("SELECT id FROM notes "
+                    "WHERE deleted < :before LIMIT :limit",
+                    {'before': before, 'limit': self.purge_batch})]
+                if ids:
+                    id_list = self._id_list(ids)
+                    for table in ("note_keywords", "note_topics", "notes"):
+                        column = table == "notes" and "id" or "note"
+                        conn.execute("DELETE FROM %s WHERE %s IN (%s)" %
+                                     (table, column, id_list))
+# The newest entry is always kept, so the revs carry on from where they were:
+                conn.execute("DELETE FROM note_log WHERE rev <= "
+                    "(SELECT MAX(rev) FROM note_log) - :keep",
+                    {'keep': self.log_keep})
+                self.session.commit()
+            except:
+                self.session.rollback()
+                raise
+            self._end_unit()
+            if len(ids) < self.purge_batch:
+                return False
+            done += 1
+        return True
+
+    def note_ids(self, first=None, last=None, topic=None):
+        """Return the ids of the notes with ids from first to last and/or
+        under the given topic, newest first, e.g. for marking a range or a
+        topic's worth of notes in the interface."""
+
+        notes = self.notes_table
+        where = [notes.c.deleted == None]
+        if first is not None:
+            where.append(notes.c.id >= first)
+        if last is not None:
+            where.append(notes.c.id <= last)
+        if topic is not None:
+            note_topics = self.note_topics_table
+            where.append(notes.c.id.in_(select([note_topics.c.note],
+                and_(note_topics.c.topic == self.topics_table.c.id,
+                    self.topics_table.c.topic == topic.lower()))))
+        query = select([notes.c.id], and_(*where)).order_by(notes.c.id.desc())
+        return [x[0] for x in self.engine.execute(query)]
 
     def get_notes(self):
         """The get_notes method reads through the database and yields note
         by note; this is useful for the initial population of the note
         interface."""
 
-        for note in self.session.query(Note).order_by(Note.c.id.desc()):
-            yield note
+        try:
+            for note in self.session.query(Note).filter(
+                    Note.c.deleted == None).order_by(Note.c.id.desc()):
+                yield note
+        finally:
+            self._end_unit()
+
+    def _get_rows(self, where=None, order_by=None, limit=None):
+        """Return a list of NoteRows, i.e. just the id, date and the first
+        preview_length characters of the body of each note, straight from
+        the notes table without building any Note objects. This goes
+        through the engine rather than the session, which gives every thread
+        its own connection, so listings (see get_note_page) can be read from
+        the interface's thread while the session is busy on another. Deleted
+        notes are always left out."""
+
+        notes = self.notes_table
+        query = select([notes.c.id, notes.c.date,
+                        func.substr(notes.c.body, 1, self.preview_length)],
+                       notes.c.deleted == None)
+        if where is not None:
+            query = query.where(where)
+        if order_by is not None:
+            query = query.order_by(order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        return [NoteRow(*x) for x in self.engine.execute(query)]
+
+    def _get_rows_by_id(self, ids):
+        """Return the NoteRows for the ids, in the same order; ids of notes
+        that don't exist (any more) or are deleted are left out."""
+
+        rows = {}
+        for i in xrange(0, len(ids), 500):
+            for row in self._get_rows(self.notes_table.c.id.in_(ids[i:i+500])):
+                rows[row.id] = row
+        return [rows[x] for x in ids if x in rows]
+
+    def get_note_page(self, before=None, after=None, limit=50, topic=None):
+        """Return up to limit NoteRows, newest first, for the notes older
+        than the note with id before or newer than the note with id after
+        (or the newest notes if neither is given), optionally only those
+        under the given topic. The ids are used as keys into the primary key
+        index, or for a topic into the (topic, note) index on its links, so
+        every page costs the same however far into the notebook (or the
+        topic) it is."""
+
+        id = self.notes_table.c.id
+        where = []
+        if topic is not None:
+            note_topics = self.note_topics_table
+            id = note_topics.c.note
+            where = [self.topics_table.c.topic == topic.lower(),
+                     note_topics.c.topic == self.topics_table.c.id,
+                     note_topics.c.note == self.notes_table.c.id]
+        if after is not None:
+            rows = self._get_rows(and_(id > after, *where), id.asc(), limit)
+            rows.reverse()
+            return rows
+        if before is not None:
+            where.append(id < before)
+        if where:
+            return self._get_rows(and_(*where), id.desc(), limit)
+        return self._get_rows(None, id.desc(), limit)
+
+    def get_topics(self):
+        """Return (topic, number of notes) for every topic with any notes,
+        in alphabetical order, from the counts kept in topic_counts."""
+
+        return [tuple(x) for x in self.session.execute(
+            "SELECT topics.topic, topic_counts.notes FROM topic_counts "
+            "JOIN topics ON topics.id = topic_counts.topic "
+            "WHERE topic_counts.notes > 0 ORDER BY topics.topic")]
+
+    def get_note(self, note_id, nearby=()):
+        """Return the fully loaded note (body, topics and keywords) with the
+        given id, or None if it doesn't exist. Notes are kept in a bounded
+        cache; on a miss the notes with the nearby ids (e.g. the rows around
+        the selection) are loaded in the same batch, so moving on to them
+        costs nothing. The note is returned as a NoteRecord, a read-only
+        copy that holds nothing of the session."""
+
+        note = self.cache.get(note_id)
+        if note is not None:
+            return note
+        ids = [note_id] + [x for x in nearby if x not in self.cache]
+        self.preload(ids)
+        return self.cache.get(note_id)
+
+    def preload(self, ids):
+        """Load the notes with the given ids into the cache in one query,
+        with their topics and keywords loaded in the same go rather than one
+        query per note."""
+
+        ids = list(ids)[:self.cache_size]
+        notes = self.session.query(Note).options(eagerload('topics'),
+            eagerload('keywords')).filter(Note.c.id.in_(ids))
+        for note in notes:
+            self.cache.put(note.id, NoteRecord(note.id, note.body, note.date,
+                note.due_date, tuple(shared(x.topic) for x in note.topics),
+                tuple(shared(x.keyword) for x in note.keywords)))
+        self._end_unit()
+
+    def related_notes(self, note, limit=10):
+        """Return NoteRows for up to limit other notes ranked by how much
+        they have in common with the given note, most related first. The
+        link tables are an inverted index (keyword or topic -> notes, kept
+        up to date by add_note and purge_deleted), so this only reads the
+        posting lists of the note's own keywords and topics rather than
+        scanning the notes table. Every shared word scores 1 / (number of
+        notes using it), so rare words count for more; words used by more
+        than common_limit notes say next to nothing about a note and are
+        skipped, which keeps the cost bounded however large the notebook
+        gets. Deleted notes are dropped from the posting lists as they're
+        read, so they neither count towards a word's notes nor take the
+        place of a live note."""
+
+        scores = {}
+        for table, column in (("note_keywords", "keyword"),
+                              ("note_topics", "topic")):
+            words = [x[0] for x in self.session.execute(
+                "SELECT %s FROM %s WHERE note = :note" % (column, table),
+                {'note': note.id})]
+            for word in words:
+                postings = [x[0] for x in self.session.execute(
+                    "SELECT note FROM %s JOIN notes ON notes.id = %s.note "
+                    "WHERE %s = :word AND notes.deleted IS NULL "
+                    "LIMIT :limit" % (table, table, column),
+                    {'word': word, 'limit': self.common_limit + 1})]
+                if len(postings) > self.common_limit:
+                    continue
+                weight = 1.0 / len(postings)
+                for other in postings:
+                    if other != note.id:
+                        scores[other] = scores.get(other, 0) + weight
+
+# Highest score first, newest note first among equals:
+        best = heapq.nlargest(limit, scores.iteritems(),
+                              key=lambda x: (x[1], x[0]))
+        return self._get_rows_by_id([x[0] for x in best])
+
+    def _get_data_version(self):
+        """PRAGMA data_version changes whenever another connection commits to
+        the database, which makes it a free "has anything happened?" check.
+        SQLite versions that don't know the pragma return no rows, so this
+        returns None and every check falls through to the note log."""
+
+        return self.session.execute("PRAGMA data_version").scalar()
+
+    def get_changes(self):
+        """Return NoteRows for the notes inserted (or restored) and the ids
+        of the notes deleted since the last call (or since this Noter was
+        created) as a tuple of (rows, deleted_ids), both in order of id.
+        When nothing has been committed in the meantime this costs a single
+        pragma, not a query against the notes table. If purge_deleted has
+        trimmed entries from the log that weren't read yet, the changes can't
+        be told any more and None is returned instead: the caller has to
+        reload whatever notes it holds."""
+
+        data_version = self._get_data_version()
+        if (not self.dirty and data_version is not None and
+                data_version == self.data_version):
+            return [], []
+        self.data_version = data_version
+        self.dirty = False
+
+        rows = self.session.execute(
+            "SELECT rev, note, action FROM note_log WHERE rev > :rev "
+            "ORDER BY rev", {'rev': self.last_rev}).fetchall()
+        if not rows:
+            return [], []
+# Revs are handed out one after the other and the log is only ever trimmed
+# from the oldest end, so a gap after the last rev read means it was trimmed:
+        if rows[0][0] > self.last_rev + 1:
+            self.last_rev = rows[-1][0]
+            self.cache.clear()
+            return None
+        self.last_rev = rows[-1][0]
+
+# Only the last thing that happened to a note matters; a note inserted and
+# deleted again since the last check is reported as deleted, which the caller
+# can ignore if it never saw the note in the first place:
+        actions = {}
+        for rev, note_id, action in rows:
+            actions[note_id] = action
+        inserted = [x for x in sorted(actions)
+                    if actions[x] in ("insert", "restore")]
+        deleted = [x for x in sorted(actions) if actions[x] == "delete"]
+        for note_id in deleted:
+            self.cache.discard(note_id)
+        return self._get_rows_by_id(inserted), deleted
+
+    def search(self, query, limit=100):
+        """Find the notes matching every word of the query, best match first,
+        and return them as a list of (NoteRow, snippet) pairs where the snippet
+        is the most relevant part of the body with the matches marked with
+        colour codes for the interface. The last word is treated as a prefix
+        so results show up while a word is still being typed."""
+
+        words = query.split()
+        if not words:
+            return []
+
+        if not self._has_fts():
+            return self._scan_search(words, limit)
+
+# Quote every word so that nothing the user types is taken as FTS query
+# syntax:
+        terms = ['"%s"' % (x.replace('"', '""'),) for x in words]
+        terms[-1] += "*"
+# Deleted notes stay in the index until they're purged, so they're left out
+# here, before the limit, rather than by _get_rows_by_id:
+        rows = self.session.execute(
+            "SELECT notes_fts.rowid, "
+            "snippet(notes_fts, 0, :start, :end, '...', 12) FROM notes_fts "
+            "JOIN notes ON notes.id = notes_fts.rowid "
+            "WHERE notes_fts MATCH :match AND notes.deleted IS NULL "
+            "ORDER BY notes_fts.rank LIMIT :limit",
+            {'start': '\x03R\x03', 'end': '\x03G\x03',
+             'match': " ".join(terms), 'limit': limit}).fetchall()
+        if not rows:
+            return []
+
+        snippets = dict(rows)
+        return [(x, snippets[x.id])
+                for x in self._get_rows_by_id([x[0] for x in rows])]
+
+    def _has_fts(self):
+        if self.fts is None:
+            self.fts = bool(self.session.execute("SELECT 1 FROM "
+                "sqlite_master WHERE type = 'table' AND name = 'notes_fts'"
+                ).scalar())
+        return self.fts
+
+    def _scan_search(self, words, limit):
+        """Fallback for search() when SQLite has no FTS5: every word must
+        appear somewhere in the body, newest notes first."""
 
-    def get_new_notes(self, offset):
-        """See if any new notes past the given offset are in the database and
-        yield them."""
-        query = self.session.query(Note).order_by(Note.c.id.asc())
-        for note in query[offset:]:
-            yield note
+        body = self.notes_table.c.body
+        where = and_(*[body.like("%" + x + "%") for x in words])
+        rows = self._get_rows(where, self.notes_table.c.id.desc(), limit)
+        return [(x, x.preview) for x in rows]
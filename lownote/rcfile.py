@@ -15,6 +15,12 @@ def _makedir(path):
 def load_rc(options):
     """Load the rc file and grab the following:
         * The location of the database;
+        * The number of notes written per transaction by --import;
+        * The socket the daemon (lownote --serve) listens on;
+        * Whether to instrument lownote (see lownote.instrument);
+        * The SQLite storage settings: journal_mode, synchronous,
+          busy_timeout, mmap_size and cache_size (see Noter.storage_defaults,
+          which are used for any that aren't set);
 
         (to be continued...)
         The object returned is an updated object of options with any options
@@ -22,6 +28,14 @@ def load_rc(options):
     """
     defaults = {
         "db_path": "~/.lownote/lownote.sqlite",
+        "batch_size": 1000,
+        "socket_path": "~/.lownote/lownote.sock",
+        "instrument": False,
+        "journal_mode": None,
+        "synchronous": None,
+        "busy_timeout": None,
+        "mmap_size": None,
+        "cache_size": None,
     }
     
     rc_default = False
@@ -43,10 +57,10 @@ def load_rc(options):
         if not rc_default:
             print "Could not read rc file: %s" % (options.rc_path,)
             raise SystemExit
-        return options
-
-    config = parse_rc(f)
-    f.close()
+        config = {}
+    else:
+        config = parse_rc(f)
+        f.close()
 
 # This is a little bit tricky, but it just checks that the key it found in the
 # config file is in the defaults (i.e. it is a valid option) and, if it is,
@@ -56,10 +70,17 @@ def load_rc(options):
         if key not in defaults:
             print "Invalid option: %s" % (key,)
             continue
-        if getattr(options, key) == "DEFAULT":
+        if getattr(options, key, None) in ("DEFAULT", None):
             setattr(options, key, config[key])
+# Anything neither the command line nor the rc file set gets the default (the
+# rc file is the only place some settings come from, so they may not be in
+# the options at all yet):
+    for key in defaults:
+        if getattr(options, key, None) in ("DEFAULT", None):
+            setattr(options, key, defaults[key])
     options.db_path = os.path.expanduser(options.db_path)
     _makedir(options.db_path)
+    options.socket_path = os.path.expanduser(options.socket_path)
     return options
 
 def get_token(tokens):
@@ -0,0 +1,104 @@
+"""Reading and writing notes in bulk, for importing them into the database
+and exporting them out of it. Records are dictionaries with a "body" and
+optionally "topics" (a list), "keywords" (a list, on top of any %%keywords%%
+in the body), "due_date" (YYYYMMDD) and "date" (the date the note was made,
+in ISO format). Exported records also carry the note's "id"."""
+import json
+import sys
+
+def open_input(path):
+    """Open the file to read records from; "-" means standard input."""
+    if path == "-":
+        return sys.stdin
+    return open(path)
+
+def read_jsonl(f):
+    """Yield one record per line of JSON; blank lines are skipped."""
+    for number, line in enumerate(f):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError, e:
+            raise ValueError("Line %d: %s" % (number + 1, e))
+        if not isinstance(record, dict) or not record.get("body"):
+            raise ValueError("Line %d: a record needs a body." % (number + 1,))
+# A lone string would otherwise be taken a character at a time:
+        for field in ("topics", "keywords"):
+            words = record.get(field, [])
+            if not isinstance(words, list) or \
+                    [x for x in words if not isinstance(x, basestring)]:
+                raise ValueError("Line %d: %s must be a list of words." %
+                                    (number + 1, field))
+        yield record
+
+def read_text(f):
+    """Yield a record for every paragraph of plain text, i.e. every run of
+    lines up to a blank line."""
+    lines = []
+    for line in f:
+        line = line.rstrip("\r\n")
+        if line.strip():
+            lines.append(line)
+        elif lines:
+            yield {"body": "\n".join(lines)}
+            lines = []
+    if lines:
+        yield {"body": "\n".join(lines)}
+
+def read_records(f):
+    """Yield the records from the file, which can be JSON lines or plain
+    text; which one is decided by whether the first line that isn't blank
+    looks like a JSON object. Input is only read once, so this works on
+    pipes too."""
+    first = ""
+    for first in f:
+        if first.strip():
+            break
+    if not first.strip():
+        return []
+
+    def lines():
+        yield first
+        for line in f:
+            yield line
+
+    if first.lstrip().startswith("{"):
+        return read_jsonl(lines())
+    return read_text(lines())
+
+def open_output(path):
+    """Open the file to write an export to; "-" (or no path) means standard
+    output."""
+    if path is None or path == "-":
+        return sys.stdout
+    return open(path, "w")
+
+def write_jsonl(records, f):
+    """Write one record per line of JSON; this is the format read_jsonl
+    reads, so an export can be imported again as it is."""
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+
+def write_markdown(records, f):
+    """Write the records as a Markdown document for reading, one section per
+    note."""
+    for record in records:
+        lines = ["## %s (#%d)" % (record["date"][:16].replace("T", " "),
+                                   record["id"]), "", record["body"], ""]
+        if record.get("topics"):
+            lines.append("*Topics:* %s  " % (", ".join(record["topics"]),))
+        if record.get("keywords"):
+            lines.append("*Keywords:* %s  " % (", ".join(record["keywords"]),))
+        if record.get("due_date"):
+            due = record["due_date"]
+            lines.append("*Due:* %s-%s-%s  " % (due[:4], due[4:6], due[6:]))
+        lines.append("")
+        f.write("\n".join(lines).encode("utf-8") + "\n")
+
+writers = {
+    "jsonl": write_jsonl,
+    "markdown": write_markdown,
+    "md": write_markdown,
+}
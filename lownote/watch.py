@@ -0,0 +1,112 @@
+"""Noticing when the database has been written to, so the interface only
+goes to the database when there's something new there. On Linux inotify
+tells us as soon as it happens without any polling at all; elsewhere the
+files are stat()ed every so often instead, which is still much cheaper than
+a query. Either way a watcher has:
+    fileno(), a descriptor that becomes readable on a change (or None);
+    timeout, how long to wait before calling changed() regardless (or None);
+    changed(), which says whether anything changed since it was last called
+    and is always safe to call."""
+import ctypes
+import ctypes.util
+import os
+import struct
+
+class PollingWatcher(object):
+    """Compares the size, modification time and inode of each file every
+    timeout seconds."""
+
+    def __init__(self, paths, timeout=0.5):
+        self.paths = paths
+        self.timeout = timeout
+        self.stamps = self._stamps()
+
+    def _stamps(self):
+        stamps = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamps.append(None)
+            else:
+                stamps.append((st.st_mtime, st.st_size, st.st_ino))
+        return stamps
+
+    def fileno(self):
+        return None
+
+    def changed(self):
+        stamps = self._stamps()
+        if stamps == self.stamps:
+            return False
+        self.stamps = stamps
+        return True
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """Watches the directory the files are in rather than the files, as
+    SQLite creates and removes its journal and WAL files as it goes."""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0x80000
+
+    timeout = None
+    event = struct.Struct("iIII")
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.names = set(os.path.basename(x) for x in paths)
+        directories = set(os.path.dirname(os.path.abspath(x)) for x in paths)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | \
+            self.IN_CREATE | self.IN_DELETE
+        for directory in directories:
+            if libc.inotify_add_watch(self.fd, directory, mask) < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, "inotify_add_watch failed")
+
+    def fileno(self):
+        return self.fd
+
+    def changed(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+# EAGAIN: nothing more to read.
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.event.unpack_from(data, offset)
+                offset += self.event.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                if mask & self.IN_Q_OVERFLOW or name in self.names:
+                    changed = True
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def watch(db_path, timeout=0.5):
+    """Return a watcher for the database and the journal or WAL next to it,
+    with inotify if it's there, otherwise polling every timeout seconds."""
+    paths = [db_path, db_path + "-wal", db_path + "-journal"]
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError):
+        return PollingWatcher(paths, timeout)
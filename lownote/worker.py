@@ -0,0 +1,135 @@
+"""Running database work on a thread of its own, so the interface never
+waits on SQL: a slow commit or a wait for another process's lock only holds
+up the worker, while keys keep being handled and the screen kept drawn.
+
+Calls are queued with submit() and run in order on the worker thread; the
+result of each is handed back to the thread that called dispatch() (the
+interface's), which is woken through fileno() becoming readable. A call
+can be given a key, in which case a call with the same key that's still
+waiting to run is replaced rather than queued a second time, so e.g.
+asking for a refresh five times while a write is in progress only
+refreshes once, and scrolling past twenty notes only loads the last. A call
+that fails has its exception raised again by dispatch(), unless it was
+given an error callback to hand it to instead (e.g. for background work
+that can just be tried again later)."""
+import collections
+import fcntl
+import os
+import sys
+import threading
+
+class Worker(object):
+    """One worker thread and the queues to and from it."""
+
+    def __init__(self):
+        self.requests = collections.deque()
+        # The requests with a key that haven't started yet, by key:
+        self.waiting = {}
+        self.results = collections.deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.read_fd, self.write_fd = os.pipe()
+        flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.thread = threading.Thread(target=self.run, name="lownote-db")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def fileno(self):
+        return self.read_fd
+
+    def submit(self, func, args=(), kwargs=None, done=None, key=None,
+               error=None):
+        """Queue func(*args, **kwargs) to run on the worker thread;
+        done(result) is called from dispatch() once it has, or if it raised,
+        error(exc_info) if given."""
+        self.condition.acquire()
+        try:
+            request = self.waiting.get(key)
+            if request is not None:
+                request[:] = [func, args, kwargs or {}, done, key, error]
+                return
+            request = [func, args, kwargs or {}, done, key, error]
+            if key is not None:
+                self.waiting[key] = request
+            self.requests.append(request)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def call(self, func, *args, **kwargs):
+        """Run func on the worker thread and wait for its result, for the
+        things that have to happen before there's anything to show anyway
+        (e.g. opening the database). Exceptions are raised here."""
+        finished = threading.Event()
+        outcome = []
+
+        def run():
+            try:
+                outcome.append((func(*args, **kwargs), None))
+            except BaseException:
+                outcome.append((None, sys.exc_info()))
+            finished.set()
+        self.submit(run)
+        finished.wait()
+        result, error = outcome[0]
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return result
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.requests and not self.stopping:
+                    self.condition.wait()
+                if not self.requests:
+                    return
+                request = self.requests.popleft()
+                if self.waiting.get(request[4]) is request:
+                    del self.waiting[request[4]]
+            finally:
+                self.condition.release()
+
+            func, args, kwargs, done, key, error = request
+            try:
+                result = (func(*args, **kwargs), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            if done is not None or result[1] is not None:
+                self.results.append((done, error) + result)
+                os.write(self.write_fd, "x")
+
+    def dispatch(self):
+        """Hand the results that have come in to their done callbacks, on
+        the calling thread, and return whether there were any. An exception
+        raised by a call is handed to its error callback, or if it hasn't
+        got one raised again here."""
+        try:
+            os.read(self.read_fd, 4096)
+        except OSError:
+            pass
+        dispatched = False
+        while self.results:
+            done, error, result, exc_info = self.results.popleft()
+            dispatched = True
+            if exc_info is None:
+                done(result)
+            elif error is not None:
+                error(exc_info)
+            else:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return dispatched
+
+    def stop(self):
+        """Let the calls already queued (e.g. a delete) finish, then end the
+        thread."""
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        self.thread.join()
+        os.close(self.read_fd)
+        os.close(self.write_fd)